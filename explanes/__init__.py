@@ -2,5 +2,6 @@ from explanes.experiment import Experiment
 from explanes.metric import Metric
 from explanes.factor import Factor
 from explanes.setting import Setting
+from explanes.pipeline import Pipeline
 import explanes.util
 import explanes.run
@@ -4,12 +4,15 @@ import inspect
 import os
 import time
 import datetime
+import weakref
+import numpy as np
+from multiprocessing import shared_memory
 import explanes as el
 
 class Experiment():
   """Stores high level information about the experiment and tools to control the processing and storage of data.
 
-  The experiment class displays high level information about the experiment in the experiment.project NameSpace such as its name, description, author, author's email address, and run identification. Information about storage of data is specified using the experiment.path NameSpace. It also stores a Factor object and a Metric object to respectively specify the factors and the metrics considered in the experiment.
+  The experiment class displays high level information about the experiment in the experiment.project NameSpace such as its name, description, author, author's email address, and run identification. Information about storage of data is specified using the experiment.path NameSpace. It also stores a Factor object and a Metric object to respectively specify the factors and the metrics considered in the experiment. Large numpy arrays needed by every setting can be stored in shared memory using the experiment.shared NameSpace, see :class:`~explanes.experiment.Shared`.
 
   See Also
   --------
@@ -41,6 +44,7 @@ class Experiment():
     storage:
     output:
   host: []
+  shared:
 
   Each level can be complemented with new members to store specific information:
 
@@ -65,6 +69,7 @@ class Experiment():
     storage:
     output:
   host: []
+  shared:
   specificInfo: stuff
   myData:
     info1: 1
@@ -93,6 +98,7 @@ class Experiment():
     self.path = Path()
     self.path.code = os.getcwd()
     self.host = []
+    self.shared = Shared()
     self._settingEncoding = {}
     self._archivePath = ''
     self._gmailId = 'expcode.mailer'
@@ -223,10 +229,11 @@ class Experiment():
       storage:
       output:
     host: []
+    shared:
 
     >>> import explanes as el
     >>> el.Experiment().__str__(format='html')
-    '<div>project: </div><div>  name: </div><div>  description: </div><div>  author: no name</div><div>  address: noname@noorg.org</div><div>  runId: ...</div><div>factor: </div><div>parameter: </div><div>metric: </div><div>path: </div><div>  input: </div><div>  processing: </div><div>  storage: </div><div>  output: </div><div>host: []</div><div></div>'
+    '<div>project: </div><div>  name: </div><div>  description: </div><div>  author: no name</div><div>  address: noname@noorg.org</div><div>  runId: ...</div><div>factor: </div><div>parameter: </div><div>metric: </div><div>path: </div><div>  input: </div><div>  processing: </div><div>  storage: </div><div>  output: </div><div>host: []</div><div>shared: </div><div></div>'
     """
     description = ''
     for atr in self._atrs:
@@ -235,6 +242,8 @@ class Experiment():
           description += atr+': \r\n'
           for sns in self.__getattribute__(atr).__dict__.keys():
             description+='  '+sns+': '+str(self.__getattribute__(atr).__getattribute__(sns))+'\r\n'
+        elif type(self.__getattribute__(atr)) == Shared:
+          description += atr+': \r\n'+str(self.__getattribute__(atr))
         elif isinstance(self.__getattribute__(atr), str) or isinstance(self.__getattribute__(atr), list):
           description+=atr+': '+str(self.__getattribute__(atr))+'\r\n'
         else:
@@ -286,13 +295,26 @@ class Experiment():
     nbJobs=1,
     progress=True,
     logFileName='',
-    mailInterval=0
+    mailInterval=0,
+    backend='sharedmem',
+    skipDone=False,
+    resume=False,
+    shard=None,
+    balance='',
+    claim=False,
+    resources=False,
+    timeout=0,
+    retries=0,
+    maxFailureRate=1,
+    memory=None,
+    memoryBudget=0,
+    profile=False
     ):
     """Operate the function with parameters on the :term:`settings<setting>` set generated using :term:`mask`.
 
     Operate a given function on the setting set generated using mask. The setting set can be browsed in parallel by setting nbJobs>1. If logFileName is not empty, a faulty setting do not stop the execution, the error is stored and another setting is executed. If progress is set to True, a graphical display of the progress through the setting set is displayed.
 
-    This function is essentially a wrapper to the function :meth:`explanes.factor.Factor.do`.
+    This function is essentially a wrapper to the function :meth:`explanes.factor.Factor.do`. If the experiment.path.output data sink is reachable, each setting is described in its manifest when it is run, see :meth:`explanes.util.readManifest`, and the run of the settings is journaled.
 
     Parameters
     ----------
@@ -303,6 +325,10 @@ class Experiment():
     function : function(:class:`~explanes.factor.Factor`, :class:`~explanes.experiment.Experiment`, \*parameters) (optional)
       A function that operates on a given setting within the experiment environnment with optional parameters.
 
+      A :class:`~explanes.pipeline.Pipeline` object can be given to run the function as stages whose outputs are reused across settings.
+
+      If the function is a coroutine function (async def), the settings are run concurrently on an event loop, at most nbJobs at a time, which is suitable for functions that mostly wait on subprocesses or I/O.
+
       If None, a description of the given setting is shown.
 
     *parameters : any type (optional)
@@ -318,7 +344,7 @@ class Experiment():
     progress : bool (optional)
       display progress of scheduling the setting set.
 
-      If True, use tqdm to display progress (default).
+      If True, use tqdm to display progress (default), with the number of failed settings, the number of running jobs and the remaining time estimated from the mean duration of the completed settings, whatever the number of jobs and the backend.
 
       If False, do not display progress.
 
@@ -334,7 +360,74 @@ class Experiment():
 
       If 0, no email is sent (default).
 
-      It >0, an email is sent as soon as an setting is done and the difference between the current time and the time the last mail was sent is larger than mailInterval.
+      It >0, an email is sent as soon as an setting is done and the difference between the current time and the time the last mail was sent is larger than mailInterval hours. The email reports the number of completed, failed settings and running jobs, the elapsed time and the estimated remaining time, whatever the number of jobs and the backend.
+
+    backend : str (optional)
+      parallel backend used if nbJobs > 1.
+
+      If 'sharedmem', the settings are processed by threads sharing the experiment, suitable for I/O bound functions (default).
+
+      If 'process', the settings are processed by a pool of processes, suitable for CPU bound functions. The function must then be defined at the top level of a module.
+
+    skipDone : bool (optional)
+      If True, the settings whose metrics, as declared in experiment.metric, are all available in the experiment.path.output data sink are not processed.
+
+      If False, every setting is processed (default).
+
+    resume : bool (optional)
+      If True, the settings that ended or failed during the run identified by experiment.status.runId are not processed.
+
+      If False, every setting is processed (default).
+
+      The start and outcome of the run of each setting are journaled in a file of the experiment.path.output data sink specific to experiment.status.runId, see :meth:`explanes.util.journalPath`. If nbJobs > 1, the durations journaled by the previous runs are used to dispatch the settings with the longest predicted duration first, see :meth:`explanes.factor.Factor.predictCost`, unless the setting set is lazy or has more than explanes.factor._maxPredictedSettings settings, in which case the settings are dispatched in the order of iteration.
+
+    shard : tuple of int or None (optional)
+      If (index, nbShards), only the settings of the shard index out of nbShards are processed, see :meth:`explanes.factor.Factor.shard`. During the run, experiment.path.output is set to the partition of the data sink specific to the shard, see :meth:`explanes.util.shardPath`.
+
+      If None, the whole setting set is processed (default).
+
+    balance : str (optional)
+      path to a json file of durations saved by :meth:`explanes.util.writeDurations`, used to balance the shards. The same file should be given to every shard, so that the shards partition the setting set whatever the journals written by the shards meanwhile.
+
+      If empty, the settings are assigned to the shards in turn (default).
+
+    claim : bool or str (optional)
+      If True or a run identifier, each setting is claimed in a directory of the experiment.path.output data sink specific to this identifier before being run, see :meth:`explanes.util.claimPath`, so that any number of runs of the experiment sharing this data sink and this identifier, launched concurrently, run each setting once. A setting that failed can be claimed again, by a concurrent run or by a later one. The settings released as done by a previous run with the same identifier are counted as already done and are not run. If True, the identifier is experiment.status.runId.
+
+      If False, the settings are not claimed (default).
+
+    resources : bool (optional)
+      If True, the wall clock time, processor time, peak resident memory and bytes read and written by each setting that succeeds are measured and stored in the experiment.path.output data sink as the metrics wallTime, cpuTime, peakMemory, readBytes and writtenBytes, see :meth:`explanes.util.measureResources`. They can then be reduced and displayed as any other metric by declaring them as members of experiment.metric. As the settings run concurrently by the sharedmem backend or a coroutine function share the process, their peak memory is the peak of the process: use the process backend to measure the peak memory of each setting.
+
+      If False, the resources are not measured (default).
+
+    timeout : float (optional)
+      If > 0, a setting lasting more than timeout seconds fails. With the process backend, a hung setting is killed. See :meth:`explanes.factor.Factor.do`.
+
+      If 0, the duration of the settings is not limited (default).
+
+    retries : int (optional)
+      number of times a failed setting is run again, after a delay of 1 second doubled at each retry. Defaults to 0.
+
+    maxFailureRate : float (optional)
+      maximal ratio of failed settings among the completed ones, above which the run is aborted. See :meth:`explanes.factor.Factor.do`.
+
+      If 1, the run is never aborted (default).
+
+    memory : function(:class:`~explanes.setting.Setting`) or None (optional)
+      returns the estimated peak memory in bytes of a setting.
+
+      If None and memoryBudget > 0, the peak memory of each setting is predicted from the peak memory measured by the previous runs with resources=True and stored in the experiment.path.output data sink, see :meth:`explanes.factor.Factor.predictCost` (default). If the setting set is lazy or has more than explanes.factor._maxPredictedSettings settings, a setting that was not measured is given the largest measured peak memory.
+
+    memoryBudget : float (optional)
+      If > 0 and nbJobs > 1, a setting is started only when the estimated memory of the running settings fits memoryBudget bytes, and the number of running settings is reduced while the processors are loaded by other processes. See :meth:`explanes.factor.Factor.do`.
+
+      If 0, up to nbJobs settings run concurrently (default).
+
+    profile : bool (optional)
+      If True, each setting is run under cProfile, and its profile is stored in a directory of the experiment.path.output data sink, see :meth:`explanes.util.profilePath`. The profiles can then be merged across settings, and grouped by the modalities of a factor, see :meth:`explanes.util.mergeProfiles`.
+
+      If False, the settings are not profiled (default).
 
     See Also
     --------
@@ -369,9 +462,145 @@ class Experiment():
     1+5=6
     1+2=3
     3+5=8
+    >>> # same with a pool of processes
+    >>> nbFailed = e.do([], myFunction, nbJobs=3, progress=False, backend='process') # doctest: +SKIP
+    1+5=6
+    3+2=5
+    1+2=3
+    3+5=8
+
+    >>> import asyncio
+    >>> # a coroutine function is run on an event loop, here with at most 2 concurrent settings
+    >>> async def myCoroutine(setting, experiment):
+    ...  await asyncio.sleep(0.1*setting.factor1)
+    ...  print('{}+{}={}'.format(setting.factor1, setting.factor2, setting.factor1+setting.factor2))
+    >>> nbFailed = e.do([], myCoroutine, nbJobs=2, progress=False)
+    1+2=3
+    1+5=6
+    3+2=5
+    3+5=8
+
+    >>> # a setting lasting more than timeout seconds fails, here the two settings with factor1 = 3, interrupted by a signal when run sequentially
+    >>> def mySlowFunction(setting, experiment):
+    ...  time.sleep(0.1*setting.factor1)
+    >>> print(e.do([], mySlowFunction, timeout=0.2, logFileName='/tmp/explanes.log', progress=False))
+    2
+    >>> # and killed with the forked child process running it with the process backend
+    >>> print(e.do([], mySlowFunction, nbJobs=2, backend='process', timeout=0.2, logFileName='/tmp/explanes.log', progress=False))
+    2
+
+    >>> # a failed setting is retried after a delay doubled at each retry, here 0.1 then 0.2 seconds
+    >>> el.setting._retryDelay = 0.1
+    >>> attempts = []
+    >>> def myFlakyFunction(setting, experiment):
+    ...  attempts.append(str(setting))
+    ...  if attempts.count(str(setting)) < 3:
+    ...    raise IOError('transient failure')
+    >>> start = time.time()
+    >>> print(e.do([0, 0], myFlakyFunction, retries=2, logFileName='/tmp/explanes.log', progress=False))
+    0
+    >>> print(len(attempts), time.time()-start >= 0.3)
+    3 True
+    >>> # the setting fails if it fails once more than retries
+    >>> print(e.do([0, 1], myFlakyFunction, retries=1, logFileName='/tmp/explanes.log', progress=False))
+    1
+    >>> el.setting._retryDelay = 1
+
+    >>> # the run is aborted once the ratio of failed settings among at least 10 completed ones exceeds maxFailureRate
+    >>> e.factor.factor3 = list(range(25))
+    >>> def myFaultyFunction(setting, experiment):
+    ...  raise ValueError
+    >>> print(e.do([], myFaultyFunction, maxFailureRate=0.5, logFileName='/tmp/explanes.log', progress=False))
+    Run aborted: 10 settings failed out of 10 completed, more than the maximal failure rate of 0.5.
+    10
+
+    >>> # settings whose estimated memory does not fit memoryBudget together are run one at a time
+    >>> import threading
+    >>> e.factor.factor3 = [0, 1]
+    >>> lock = threading.Lock()
+    >>> running = {'now': 0, 'max': 0}
+    >>> def myLargeFunction(setting, experiment):
+    ...  with lock:
+    ...    running['now'] += 1
+    ...    running['max'] = max(running['max'], running['now'])
+    ...  time.sleep(0.05)
+    ...  with lock:
+    ...    running['now'] -= 1
+    >>> nbFailed = e.do([], myLargeFunction, nbJobs=4, memory=lambda setting: 1e9, memoryBudget=1.5e9, progress=False)
+    >>> print(running['max'])
+    1
+
+    >>> # progress mails are sent when a setting is done more than mailInterval hours after the last mail, here with a mailer printing them
+    >>> def myMailer(title, body):
+    ...  print(title.strip())
+    ...  for line in body.split(' <br>'):
+    ...    print(line)
+    >>> e.sendMail = myMailer
+    >>> def mySecondFunction(setting, experiment):
+    ...  time.sleep(1)
+    >>> nbFailed = e.do([-1, 0, 0], mySecondFunction, mailInterval=1e-6, progress=False)
+    progress 50%
+    50% of settings done: 1 over 2
+    Failed: 0
+    Claimed by other runs: 0
+    Running: 1
+    Time elapsed: 0d 00h 00m 01s
+    Estimated time remaining: 0d 00h 00m 01s
+    >>> nbFailed = e.do([-1, 0, 0], myFunction, mailInterval=1, progress=False)
+    1+2=3
+    3+2=5
     """
 
-    return self.factor.mask(mask).do(function, self, *parameters, nbJobs=nbJobs, progress=progress, logFileName=logFileName, mailInterval=mailInterval)
+    factor = self.factor.mask(mask)
+    output = getattr(self.path, 'output', '')
+    outputRaw = getattr(self.path, 'output_raw', '')
+    journal = ''
+    claims = ''
+    sink = ''
+    manifest = ''
+    profiles = ''
+    costs = None
+    balancing = None
+    if shard and balance:
+      balancing = factor.predictCost(el.util.readDurations(balance), self._settingEncoding)
+    if function and output and os.path.isdir(os.path.dirname(el.util.manifestPath(output))):
+      # predicting the costs of a lazy or large setting set would expand it in memory
+      predictable = not factor._lazy and len(factor) <= el.factor._maxPredictedSettings
+      if nbJobs != 1 and predictable:
+        durations = el.util.readDurations(output)
+        if durations:
+          costs = factor.predictCost(durations, self._settingEncoding)
+      if memoryBudget > 0 and memory is None:
+        peaks = el.util.readMeasures(output, 'peakMemory')
+        if peaks and predictable:
+          memory = factor.predictCost(peaks, self._settingEncoding)
+        elif peaks:
+          # the peak memory of a setting not measured yet is taken as the largest measured one
+          largest = max(peaks.values())
+          memory = lambda setting: peaks.get(setting.id(**self._settingEncoding), largest)
+      if shard:
+        # the shard is stored in its own partition of the data sink
+        output = el.util.shardPath(output, *shard)
+        os.makedirs(os.path.dirname(el.util.manifestPath(output)), exist_ok=True)
+        self.path.output = el.util.shardPath(outputRaw, *shard)
+      manifest = el.util.manifestPath(output)
+      journal = el.util.journalPath(output, self.status.runId)
+      if claim:
+        claims = el.util.claimPath(output, claim if isinstance(claim, str) else self.status.runId)
+        os.makedirs(claims, exist_ok=True)
+      if resources:
+        sink = output
+      if profile:
+        profiles = el.util.profilePath(output)
+        os.makedirs(profiles, exist_ok=True)
+    if profile and function and not profiles:
+      print('Profiling requires an existing experiment.path.output data sink.')
+      raise ValueError
+    try:
+      return factor.do(function, self, *parameters, nbJobs=nbJobs, progress=progress, logFileName=logFileName, mailInterval=mailInterval, backend=backend, skipDone=skipDone, journal=journal, resume=resume, costs=costs, shard=shard, balance=balancing, claims=claims, resources=sink, timeout=timeout, retries=retries, maxFailureRate=maxFailureRate, memory=memory, memoryBudget=memoryBudget, profile=profiles, manifest=manifest)
+    finally:
+      if shard and output:
+        self.path.output = outputRaw
 
   def cleanDataSink(
     self,
@@ -387,6 +616,8 @@ class Experiment():
 
     This method is essentially a wrapper to :meth:`explanes.factor.Factor.cleanDataSink`.
 
+    The journals of the runs and the manifest of the data sink, see :meth:`explanes.experiment.Experiment.do`, do not correspond to any setting and are therefore never removed nor moved: a journal is kept after its run so that its durations can be used to predict the cost of the settings in later runs. Journals accumulate with the runs and can be removed manually once their history is no longer needed.
+
     Parameters
     ----------
 
@@ -439,18 +670,20 @@ class Experiment():
     ...   np.save(experiment.path.output+'/'+setting.id()+'_sum.npy', setting.factor1+setting.factor2)
     ...   np.save(experiment.path.output+'/'+setting.id()+'_mult.npy', setting.factor1*setting.factor2)
     >>> nbFailed = e.do([], myFunction, progress=False)
-    >>> os.listdir(e.path.output)
-    ['factor1_3_factor2_2_sum.npy', 'factor1_3_factor2_2_mult.npy', 'factor1_3_factor2_4_mult.npy', 'factor1_1_factor2_2_sum.npy', 'factor1_1_factor2_4_mult.npy', 'factor1_3_factor2_4_sum.npy', 'factor1_1_factor2_2_mult.npy', 'factor1_1_factor2_4_sum.npy']
+    >>> sorted(os.listdir(e.path.output))
+    ['.journal_...jsonl', '.manifest.jsonl', 'factor1_1_factor2_2_mult.npy', 'factor1_1_factor2_2_sum.npy', 'factor1_1_factor2_4_mult.npy', 'factor1_1_factor2_4_sum.npy', 'factor1_3_factor2_2_mult.npy', 'factor1_3_factor2_2_sum.npy', 'factor1_3_factor2_4_mult.npy', 'factor1_3_factor2_4_sum.npy']
 
     >>> e.cleanDataSink('output', [0], force=True)
-    >>> os.listdir(e.path.output)
-    ['factor1_3_factor2_2_sum.npy', 'factor1_3_factor2_2_mult.npy', 'factor1_3_factor2_4_mult.npy', 'factor1_3_factor2_4_sum.npy']
+    {...}
+    >>> sorted(os.listdir(e.path.output))
+    ['.journal_...jsonl', '.manifest.jsonl', 'factor1_3_factor2_2_mult.npy', 'factor1_3_factor2_2_sum.npy', 'factor1_3_factor2_4_mult.npy', 'factor1_3_factor2_4_sum.npy']
 
     >>> e.cleanDataSink('output', [1, 1], force=True, reverse=True, selector='*mult*')
-    >>> os.listdir(e.path.output)
-    ['factor1_3_factor2_2_sum.npy', 'factor1_3_factor2_4_mult.npy', 'factor1_3_factor2_4_sum.npy']
+    {...}
+    >>> sorted(os.listdir(e.path.output))
+    ['.journal_...jsonl', '.manifest.jsonl', 'factor1_3_factor2_2_sum.npy', 'factor1_3_factor2_4_mult.npy', 'factor1_3_factor2_4_sum.npy']
 
-    Here, we remove all the files that match the wildcard *mult* in the directory /tmp/test that do not correspond to the settings that have the first factor set to the second modality and the second factor set to the second modality.
+    Here, we remove all the files that match the wildcard *mult* in the directory /tmp/test that do not correspond to the settings that have the first factor set to the second modality and the second factor set to the second modality. The journals of the runs and the manifest are kept.
 
     >>> import explanes as el
     >>> import tables as tb
@@ -569,6 +802,82 @@ class Path:
       object.__setattr__(self, name+'_raw', value)
       object.__setattr__(self, name, os.path.expanduser(value))
 
+class Shared:
+  """stores numpy arrays in shared memory.
+
+  Each numpy array set as a member is copied once in a block of shared memory and replaced by a read-only view of this block. When the experiment is sent to the processes of the process backend of :meth:`explanes.experiment.Experiment.do`, only the names of the blocks are sent, and each process attaches to the blocks without copying the arrays. The blocks are released when the object that created them is deleted.
+
+  Examples
+  --------
+
+  >>> import explanes as el
+  >>> import numpy as np
+  >>> import pickle
+  >>> e = el.experiment.Experiment()
+  >>> e.shared.data = np.arange(6).reshape(2, 3)
+  >>> print(e.shared)
+    data: int64 (2, 3)
+  >>> e.shared.data.flags.writeable
+  False
+  >>> # a copy attaches to the same block of shared memory
+  >>> copy = pickle.loads(pickle.dumps(e.shared))
+  >>> print(copy.data)
+  [[0 1 2]
+   [3 4 5]]
+  """
+  def __init__(self):
+    object.__setattr__(self, '_memories', {})
+
+  def __setattr__(
+    self,
+    name,
+    value
+    ):
+    array = np.asarray(value)
+    if array.dtype.hasobject:
+      print('Only numpy arrays of numerical types can be shared, the array '+name+' is of type '+str(array.dtype)+'.')
+      raise ValueError
+    if name in self._memories:
+      delattr(self, name)
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+    shared[...] = array
+    shared.flags.writeable = False
+    # the block is released when this object is deleted
+    self._memories[name] = (memory, weakref.finalize(self, memory.unlink))
+    object.__setattr__(self, name, shared)
+
+  def __delattr__(
+    self,
+    name
+    ):
+    object.__delattr__(self, name)
+    memory, finalizer = self._memories.pop(name)
+    if finalizer:
+      finalizer()
+
+  def __getstate__(self):
+    return {name: (memory.name, getattr(self, name).shape, getattr(self, name).dtype.str) for name, (memory, finalizer) in self._memories.items()}
+
+  def __setstate__(
+    self,
+    state
+    ):
+    # attach to the blocks of shared memory, which are not released by this object
+    object.__setattr__(self, '_memories', {})
+    for name, (memoryName, shape, dtype) in state.items():
+      memory = shared_memory.SharedMemory(name=memoryName)
+      shared = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+      shared.flags.writeable = False
+      self._memories[name] = (memory, None)
+      object.__setattr__(self, name, shared)
+
+  def __str__(self):
+    description = ''
+    for name in self._memories:
+      description += '  '+name+': '+str(getattr(self, name).dtype)+' '+str(getattr(self, name).shape)+'\r\n'
+    return description
+
 
 if __name__ == '__main__':
     import doctest
@@ -5,19 +5,229 @@ import numpy as np
 import tables as tb
 import pandas as pd
 import copy
-import glob
 import explanes.util as eu
 import explanes.setting as es
 import logging
-from joblib import Parallel, delayed
 from subprocess import call
 import time
+import hashlib
+import math
+import bisect
+import json
+import fnmatch
+import multiprocessing
+import multiprocessing.pool
+import itertools
+import queue
+import asyncio
+import heapq
 
 if eu.inNotebook():
     from tqdm.notebook import tqdm as tqdm
 else:
     from tqdm import tqdm as tqdm
 
+# number of settings of a boolean selection summarized by a count in lazy mode
+_selectionChunkSize = 2**16
+# number of settings decoded at once when dispatching them lazily
+_decodeChunkSize = 2**16
+# number of settings on which constraints are evaluated at once
+_constraintChunkSize = 2**20
+
+# private attributes whose change invalidates the setting set or the ids, handled by Factor.__setattr__
+_trackedAttributes = {'_mask', '_lazy', '_constraints', '_default'}
+
+# maximal number of settings whose costs are predicted to dispatch them longest first, as the prediction requires the id of every setting
+_maxPredictedSettings = 10**6
+
+# targeted duration in seconds of a batch of settings dispatched to a job
+_batchDuration = 0.2
+
+# state of a worker of the process backend, set once per worker by _initWorker
+_worker = None
+
+# minimal number of completed settings before the failure rate of a run is checked
+_failureRateSample = 10
+
+def _initWorker(factor, function, experiment, logFileName, parameters, options):
+  global _worker
+  _worker = (factor, function, experiment, logFileName, parameters, options)
+
+def _runBatch(factor, batch, function, experiment, logFileName, parameters, options):
+  # runs the function on a batch of settings given as tuples of modality indexes, with the keyword arguments options of explanes.setting.Setting.do, returns the number of failed settings, the number of run settings, the duration of the batch and the number of settings claimed by other runs
+  startTime = time.time()
+  nbFailed = 0
+  nbSkipped = 0
+  for setting in batch:
+    failed = es.Setting(factor, setting).do(function, experiment, logFileName, *parameters, **options)
+    if failed is None:
+      nbSkipped += 1
+    else:
+      nbFailed += failed
+  return nbFailed, len(batch)-nbSkipped, time.time()-startTime, nbSkipped
+
+def _doBatch(batch):
+  return _runBatch(_worker[0], batch, *_worker[1:])
+
+class _Progress():
+  # tracks the number of completed and failed settings, of settings claimed by other runs and of running jobs, drives the progress bar and the progress mails
+  def __init__(self, nbSettings, nbJobs, progress, mailInterval, experiment, maxFailureRate=1):
+    self.nbSettings = nbSettings
+    self.nbJobs = nbJobs
+    self.mailInterval = mailInterval
+    self.maxFailureRate = maxFailureRate
+    self.experiment = experiment
+    self.nbDone = 0
+    self.nbFailed = 0
+    # settings not run as they are claimed by other runs
+    self.nbSkipped = 0
+    self.nbRunning = 0
+    # cumulated duration of the completed settings
+    self.duration = 0
+    self.startTime = time.time()
+    self.mailTime = self.startTime
+    self.bar = tqdm(total=nbSettings, disable= not progress)
+
+  def eta(self):
+    # remaining time in seconds, estimated from the mean duration of the completed settings and the number of jobs
+    nbRemaining = self.nbSettings-self.nbDone-self.nbSkipped
+    if not self.nbDone or not nbRemaining:
+      return 0
+    return self.duration/self.nbDone*nbRemaining/min(self.nbJobs, nbRemaining)
+
+  def aborted(self):
+    # True if the ratio of failed settings among the completed ones exceeds maxFailureRate
+    return self.nbDone >= min(_failureRateSample, self.nbSettings) and self.nbFailed > self.maxFailureRate*self.nbDone
+
+  def running(self, nbRunning, description=''):
+    self.nbRunning = nbRunning
+    self.refresh(description)
+
+  def update(self, nbDone=1, nbFailed=0, duration=0, nbSkipped=0):
+    self.nbDone += nbDone
+    self.nbFailed += nbFailed
+    self.nbSkipped += nbSkipped
+    self.duration += duration
+    self.refresh()
+    self.bar.update(nbDone+nbSkipped)
+    if self.mailInterval>0 and self.nbDone+self.nbSkipped<self.nbSettings and (time.time()-self.mailTime)/(60**2) > self.mailInterval:
+      self.mailTime = time.time()
+      percentage = int((self.nbDone+self.nbSkipped)/self.nbSettings*100)
+      message = '{}% of settings done: {} over {} <br>Failed: {} <br>Claimed by other runs: {} <br>Running: {} <br>Time elapsed: {} <br>Estimated time remaining: {}'.format(percentage, self.nbDone, self.nbSettings, self.nbFailed, self.nbSkipped, self.nbRunning, _formatDuration(self.mailTime-self.startTime), _formatDuration(self.eta()))
+      self.experiment.sendMail('progress {}% '.format(percentage), message)
+
+  def refresh(self, description=''):
+    if self.nbSkipped:
+      description = '[claimed elsewhere: '+str(self.nbSkipped)+']'+description
+    if self.nbFailed:
+      description = '[failed: '+str(self.nbFailed)+']'+description
+    self.bar.set_description(description, refresh=False)
+    postfix = {'running': self.nbRunning}
+    if self.nbDone:
+      postfix['eta'] = _formatDuration(self.eta())
+    self.bar.set_postfix(postfix, refresh=False)
+    # redraw at most every mininterval seconds, as the bar does on update
+    if not self.bar.disable and time.time()-self.bar.last_print_t > self.bar.mininterval:
+      self.bar.refresh()
+
+  def close(self):
+    self.nbRunning = 0
+    self.refresh()
+    self.bar.close()
+
+class _Admission():
+  # admits a setting when its estimated memory fits the memory budget and the memory available on the system, and when the processors have room for it given the load of the system
+  def __init__(self, budget, nbJobs):
+    self.budget = budget
+    self.nbJobs = nbJobs
+    # estimated memory of the running settings
+    self.memory = 0
+    self.nbRunning = 0
+
+  def limit(self):
+    # number of jobs, reduced by the load of the system not due to the running settings, in excess of the processors left free by the jobs
+    try:
+      load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+      return self.nbJobs
+    excess = max(load-self.nbRunning, 0)-max(os.cpu_count()-self.nbJobs, 0)
+    return max(1, self.nbJobs-int(max(excess, 0)))
+
+  def admit(self, memory):
+    # a setting is always admitted if no setting is running, so that a setting larger than the budget is run alone
+    if not self.nbRunning:
+      return True
+    if self.nbRunning >= self.limit() or self.memory+memory > self.budget:
+      return False
+    available = eu.availableMemory()
+    return available is None or memory <= available
+
+  def start(self, memory):
+    self.nbRunning += 1
+    self.memory += memory
+
+  def stop(self, memory):
+    self.nbRunning -= 1
+    self.memory -= memory
+
+def _isin(values, modalities):
+  # membership of modality values in a list of modalities, compared one by one for object arrays, whose values can be lists
+  if values.dtype == object:
+    return np.array([any(v == m for m in modalities) for v in values], dtype=bool)
+  return np.isin(values, modalities)
+
+class _Exclusion():
+  # constraint discarding the settings where each factor has one of the given modalities, a module-level class so that it can be pickled by the process backend
+  def __init__(self, modalities):
+    self.modalities = modalities
+
+  def __call__(self, values):
+    return ~np.logical_and.reduce([_isin(getattr(values, f), m) for f, m in self.modalities.items()])
+
+class _Membership():
+  # constraint keeping the settings of at least one of the given experiments, each given as a dict mapping factors to their modalities
+  def __init__(self, experiments):
+    self.experiments = experiments
+
+  def __call__(self, values):
+    return np.logical_or.reduce([np.logical_and.reduce([_isin(getattr(values, f), m) for f, m in e.items()]) for e in self.experiments])
+
+class _Modalities():
+  # ordered set of modalities, hashable modalities being indexed by a dict and the others, such as lists, being compared by equality
+  def __init__(self):
+    self.positions = {}
+    self.modalities = []
+
+  def add(self, modality):
+    try:
+      if modality not in self.positions:
+        self.positions[modality] = len(self.modalities)
+        self.modalities.append(modality)
+    except TypeError:
+      if modality not in self.modalities:
+        self.modalities.append(modality)
+
+  def __contains__(self, modality):
+    try:
+      return modality in self.positions
+    except TypeError:
+      return modality in self.modalities
+
+  def __iter__(self):
+    return iter(self.modalities)
+
+def _formatDuration(duration):
+  return str(int(duration//86400))+'d '+time.strftime('%Hh %Mm %Ss', time.gmtime(duration))
+
+def _batchSize(nbDone, duration, nbRemaining, nbJobs):
+  # number of settings of the next batch, such that a batch lasts about _batchDuration seconds given the observed durations, while keeping enough batches to balance the load among the jobs
+  if not nbDone:
+    return 1
+  size = nbRemaining//(2*nbJobs)
+  if duration > 0:
+    size = min(size, int(_batchDuration*nbDone/duration))
+  return max(size, 1)
+
 class Factor():
   """stores the different factors of the explanes experiment.
 
@@ -25,6 +235,8 @@ class Factor():
 
   To browse the setting set defined by the Factor object, one must iterate over the Factor object.
 
+  As the factors are members of the Factor object and of its settings, a factor can not be named after a method of the Factor object, such as mask or do, nor after a method of the :class:`~explanes.setting.Setting` object: id, replace, do, doAsync and remove. An exception is raised otherwise.
+
   Examples
   --------
 
@@ -44,17 +256,33 @@ class Factor():
   factor1 1 factor2 4
   factor1 3 factor2 2
   factor1 3 factor2 4
+
+  >>> f.id = [0, 1]
+  Traceback (most recent call last):
+  ...
+  Exception: the factor id is shadowing a method of explanes.setting.Setting
   """
   def __init__(self):
       self._setting = None
       self._changed = False
       self._currentSetting = 0
-      self._settings = []
+      self._settings = np.empty((0, 0), dtype=np.int8)
+      self._maskRows = []
+      self._settingOffsets = [0]
+      self._nbSettings = 0
+      self._maskRowIndexes = None
+      self._selection = None
+      self._selectionCounts = None
+      self._slices = ()
       self._mask = None
       self._nonSingleton = []
       self._factors = []
+      self._factorPositions = {}
+      self._idTokens = {}
       self._default = types.SimpleNamespace()
       self._maskVolatile = True
+      self._lazy = False
+      self._constraints = []
 
   def copy(self):
     return copy.deepcopy(self)
@@ -118,6 +346,7 @@ class Factor():
         print('The default modality of factor '+factor+' should be available in the set of modalities.')
         raise ValueError
       self._default.__setattr__(factor, modality)
+      self._idTokens = {}
     else:
       print('Please set the factor '+factor+' before choosing its default modality.')
       raise ValueError
@@ -130,7 +359,23 @@ class Factor():
     nbJobs=1,
     progress=True,
     logFileName='',
-    mailInterval=0):
+    mailInterval=0,
+    backend='sharedmem',
+    skipDone=False,
+    journal='',
+    resume=False,
+    costs=None,
+    shard=None,
+    balance=None,
+    claims='',
+    resources='',
+    timeout=0,
+    retries=0,
+    maxFailureRate=1,
+    memory=None,
+    memoryBudget=0,
+    profile='',
+    manifest=''):
     """iterate over the setting set and run the function given as parameter.
 
     This function is wrapped by :meth:`explanes.experiment.Experiment.do`, which should be more convenient to use. Please refer to this method for usage.
@@ -141,6 +386,8 @@ class Factor():
     function : function(:class:`~explanes.factor.Factor`, :class:`~explanes.experiment.Experiment`, \*parameters)
       operates on a given setting within the experiment environnment with optional parameters.
 
+      If the function is a coroutine function (async def), the settings are run on an event loop, nbJobs being the maximal number of settings run concurrently.
+
     experiment:
       an :class:`~explanes.experiment.Experiment` object
 
@@ -157,7 +404,7 @@ class Factor():
     progress : bool (optional)
       display progress of scheduling the setting set.
 
-      If True, use tqdm to display progress (default).
+      If True, use tqdm to display progress (default), with the number of failed settings, the number of running jobs and the remaining time estimated from the mean duration of the completed settings, whatever the number of jobs and the backend.
 
       If False, do not display progress.
 
@@ -168,50 +415,275 @@ class Factor():
 
       If not empty, the execution is not stopped on a faulty setting, and the error is logged in the logFileName file.
 
+    mailInterval : float (optional)
+      interval in hours for sending email about the progress of the run, see :meth:`explanes.experiment.Experiment.do`.
+
+      If 0, no email is sent (default).
+
+    backend : str (optional)
+      parallel backend used if nbJobs > 1.
+
+      If 'sharedmem', the settings are processed by threads sharing the experiment (default). This is suitable for steps that mostly wait on I/O.
+
+      If 'process', the settings are processed by a pool of processes, the function, the experiment and the parameters being sent once to each process and each setting being sent as a tuple of modality indexes. This is suitable for CPU bound steps.
+
+      For both backends, the settings are dispatched by batches, whose size is tuned from the observed durations of the previous batches, so that running many settings with short durations is not slowed down by the cost of dispatching.
+
+    skipDone : bool (optional)
+      If True, the settings whose metrics are all available in the experiment.path.output data sink are not processed, see :meth:`explanes.factor.Factor.done`.
+
+      If False, every setting of the setting set is processed (default).
+
+    journal : str (optional)
+      path to a file where the start and the outcome of the run of each setting are appended, see :meth:`explanes.setting.Setting.do`.
+
+      If empty, no journal is kept (default).
+
+    resume : bool (optional)
+      If True, the settings that ended or failed according to the journal are not processed.
+
+      If False, the journal is not read (default).
+
+    costs : ndarray of float or None (optional)
+      cost of each setting of the setting set, for example predicted with :meth:`explanes.factor.Factor.predictCost`.
+
+      If not None and nbJobs > 1, the settings are dispatched by decreasing cost, so that the longest settings do not delay the end of the run.
+
+      If None, the settings are dispatched in the order of iteration (default).
+
+    shard : tuple of int or None (optional)
+      If (index, nbShards), only the settings of the shard index out of nbShards are processed, see :meth:`explanes.factor.Factor.shard`.
+
+      If None, the whole setting set is processed (default).
+
+    balance : ndarray of float or None (optional)
+      cost of each setting of the setting set used to balance the shards. Every shard should be given the same costs, so that the shards partition the setting set.
+
+      If None, the settings are assigned to the shards in turn (default).
+
+    claims : str (optional)
+      path to a directory where each setting is claimed before being run, so that several independent runs of the same setting set, possibly on different hosts sharing the directory, cooperatively process the settings, each setting being run once, see :meth:`explanes.util.claim`. The settings already released as done in the directory are not run. A setting that failed or was interrupted is released without being marked as processed, so that another run can claim it again. The settings claimed by other runs are counted apart from the completed ones on the progress bar.
+
+      If empty, the settings are not claimed (default).
+
+    resources : str (optional)
+      path to a data sink where the resources used by each setting that succeeds are stored as metrics, see :meth:`explanes.util.measureResources` and :meth:`explanes.util.storeResources`. If nbJobs > 1 with the sharedmem backend or a coroutine function, the settings share the process, and the peak memory measured for a setting is the peak of the process.
+
+      If empty, the resources are not measured (default).
+
+    timeout : float (optional)
+      If > 0, a setting whose function lasts more than timeout seconds fails. With the process backend, the function is run in a forked child process that is killed on timeout. Otherwise, the function is interrupted by a signal, which is not supported by the sharedmem backend with nbJobs > 1. The function of a coroutine is cancelled on timeout.
+
+      If 0, the duration of the settings is not limited (default).
+
+    retries : int (optional)
+      number of times a failed setting is run again, after a delay doubled at each retry, see :meth:`explanes.setting.Setting.do`. Defaults to 0.
+
+    maxFailureRate : float (optional)
+      maximal ratio of failed settings among the completed ones. Once at least 10 settings are completed, the run is aborted if this ratio is exceeded: no new setting is dispatched, the dispatched ones are completed and journaled, a message is printed, and the number of failed settings is returned. Only relevant if logFileName is not empty, as the run is stopped on the first failure otherwise.
+
+      If 1, the run is never aborted (default).
+
+    memory : function(:class:`~explanes.setting.Setting`) or array of float or None (optional)
+      estimated peak memory in bytes of each setting, given as a function of the setting, or as an array with the estimate of each setting of the setting set, in the order of iteration, as returned by :meth:`explanes.factor.Factor.predictCost`.
+
+      If None, the settings are assumed to need no memory (default).
+
+    memoryBudget : float (optional)
+      If > 0 and nbJobs > 1, the settings are dispatched one at a time, and a setting is started only when the sum of the estimated memory of the running settings fits memoryBudget bytes and its estimated memory is available on the system. Furthermore, the number of running settings is reduced below nbJobs while the processors are loaded by other processes. Settings are started in order, a setting that does not fit waiting for running settings to complete. A setting is always started if no setting is running. This admission control is not applied to coroutine functions.
+
+      If 0, up to nbJobs settings run concurrently (default).
+
+    profile : str (optional)
+      path to a directory where the profile of each setting, run under cProfile, is stored, see :meth:`explanes.util.mergeProfiles`. Profiling is not supported for coroutine functions, nor by the sharedmem backend with nbJobs > 1, as a profiler observes all the threads of a process.
+
+      If empty, the settings are not profiled (default).
+
+    manifest : str (optional)
+      path to the manifest of a data sink, where the description of each setting not yet described is appended when it is run, see :meth:`explanes.util.manifestPath`.
+
+      If empty, the settings are not described (default).
+
     See Also
     --------
 
-    explanes.experiment.Experiment.do
+    explanes.experiment.Experiment.do, explanes.factor.Factor.done
 
     """
-    nbFailed = 0
     if logFileName:
       logging.basicConfig(filename=logFileName,
                 level=logging.DEBUG,
                 format='%(levelname)s: %(asctime)s %(message)s',
                 datefmt='%m/%d/%Y %I:%M:%S')
+    # settings not to be run, None if every setting is run, so that no array is built over the setting set
+    done = None
+    if skipDone:
+      done = self.done(getattr(experiment.path, 'output', ''), experiment.metric.name(), experiment._settingEncoding)
+    if shard is not None:
+      outside = ~self.shard(shard[0], shard[1], balance)
+      done = outside if done is None else done | outside
+    if resume and journal:
+      finished = set(record['id'] for record in eu.readJournal(journal) if record['event'] in ['end', 'failed'])
+      resumed = np.array([id in finished for id in self.ids(**experiment._settingEncoding)], dtype=bool)
+      done = resumed if done is None else done | resumed
+    if claims and any(name.endswith('.done') for name in os.listdir(claims)):
+      # settings released as done by a previous run sharing the claim directory
+      released = np.array(eu.released(claims, self.ids(**experiment._settingEncoding)), dtype=bool)
+      done = released if done is None else done | released
+    nbSettings = len(self)-(int(np.count_nonzero(done)) if done is not None else 0)
     if progress:
-      print('Number of settings: '+str(len(self)))
-    if nbJobs>1 or nbJobs<0:
-      # print(nbJobs)
-      result = Parallel(n_jobs=nbJobs, require='sharedmem')(delayed(setting.do)(function, experiment, logFileName, *parameters) for setting in self)
-    else:
-      startTime = time.time()
-      stepTime = startTime
-      with tqdm(total=len(self), disable= not progress) as t:
-        for iSetting, setting in enumerate(self):
-            description = ''
-            if nbFailed:
-                description = '[failed: '+str(nbFailed)+']'
-            description += str(setting)
-            t.set_description(description)
-            if function:
-              nbFailed += setting.do(function, experiment, logFileName, *parameters)
+      print('Number of settings: '+str(nbSettings))
+      if skipDone or resume or claims:
+        print('Number of settings already done: '+str(len(self)-nbSettings))
+    if nbJobs<0:
+      nbJobs = max(os.cpu_count()+1+nbJobs, 1)
+    if (nbJobs>1 or inspect.iscoroutinefunction(function)) and costs is None and (memory is None or callable(memory)):
+      # no ordering nor alignment of estimates needed: settings are decoded by chunks as they are dispatched
+      settings = (tuple(setting) for chunk in self.__settingChunks__(done) for setting in chunk.tolist())
+    elif nbJobs>1 or inspect.iscoroutinefunction(function):
+      selected = ~done if done is not None else slice(None)
+      settings = self.__settingMatrix__()[selected]
+      order = np.arange(len(settings))
+      if costs is not None:
+        # longest processing time first
+        order = np.argsort(-np.asarray(costs)[selected], kind='stable')
+      settings = map(tuple, settings[order].tolist())
+      if memory is not None and not callable(memory):
+        memory = iter(np.asarray(memory, dtype=float)[selected][order].tolist())
+    # keyword arguments of explanes.setting.Setting.do
+    options = {'journal': journal, 'claims': claims, 'resources': resources, 'timeout': timeout, 'retries': retries, 'manifest': manifest}
+    if manifest:
+      # the manifest is read once, so that only the settings not yet described are appended to it
+      options['described'] = set(record['id'] for record in eu.readJournal(manifest) if 'id' in record)
+    if resources and nbJobs>1 and (backend == 'sharedmem' or inspect.iscoroutinefunction(function)):
+      # the settings share the process, whose peak memory should not be reset by each of them
+      options['concurrent'] = True
+    if timeout and nbJobs>1 and not inspect.iscoroutinefunction(function):
+      if backend == 'sharedmem':
+        print('Timeouts are not supported by the sharedmem backend with nbJobs > 1. Please use the process backend.')
+        raise ValueError
+      if not hasattr(os, 'fork'):
+        print('Timeouts are not supported by the process backend on this platform.')
+        raise ValueError
+      options['kill'] = True
+    if profile:
+      if inspect.iscoroutinefunction(function) or (nbJobs>1 and backend == 'sharedmem'):
+        print('Profiling is not supported for coroutine functions, nor by the sharedmem backend with nbJobs > 1. Please use the process backend.')
+        raise ValueError
+      options['profile'] = profile
+    status = _Progress(nbSettings, nbJobs if function else 1, progress, mailInterval, experiment, maxFailureRate)
+    try:
+      self.__doWith__(status, settings if nbJobs>1 or inspect.iscoroutinefunction(function) else None, done, nbSettings, function, experiment, logFileName, parameters, nbJobs, backend, options, memory, memoryBudget)
+    finally:
+      status.close()
+    if status.aborted():
+      print('Run aborted: {} settings failed out of {} completed, more than the maximal failure rate of {}.'.format(status.nbFailed, status.nbDone, maxFailureRate))
+      if journal:
+        eu.writeJournal(journal, {'event': 'aborted', 'time': time.time(), 'nbDone': status.nbDone, 'nbFailed': status.nbFailed, 'nbSkipped': status.nbSkipped})
+    return status.nbFailed
+
+  def __doWith__(self, status, settings, done, nbSettings, function, experiment, logFileName, parameters, nbJobs, backend, options, memory, memoryBudget):
+    # runs the settings, reporting progress to status, until all the settings are done or the run is aborted
+    if inspect.iscoroutinefunction(function):
+      coroutine = self.__doAsync__(settings, nbSettings, function, experiment, logFileName, parameters, nbJobs, status, options)
+      if eu.inNotebook():
+        # the event loop of the notebook is already running
+        with multiprocessing.pool.ThreadPool(1) as pool:
+          pool.apply(asyncio.run, (coroutine,))
+      else:
+        asyncio.run(coroutine)
+    elif nbJobs>1:
+      if backend == 'process':
+        pool = multiprocessing.Pool(nbJobs, initializer=_initWorker, initargs=(self, function, experiment, logFileName, parameters, options))
+      elif backend == 'sharedmem':
+        pool = multiprocessing.pool.ThreadPool(nbJobs)
+      else:
+        print('Unrecognized backend: '+backend+'. Please choose between sharedmem and process.')
+        raise ValueError
+      results = queue.Queue()
+      nbDispatched = 0
+      nbBatches = 0
+      admission = _Admission(memoryBudget, nbJobs) if memoryBudget > 0 else None
+      # next setting and its estimated memory, waiting for admission
+      pending = None
+      with pool:
+        while True:
+          # keep two batches per job in flight, or one setting per job admitted under the memory budget
+          while nbBatches < (nbJobs if admission else 2*nbJobs) and nbDispatched < nbSettings and not status.aborted():
+            estimate = 0
+            if admission:
+              if pending is None:
+                setting = next(settings)
+                if callable(memory):
+                  pending = (setting, memory(es.Setting(self, setting)))
+                else:
+                  pending = (setting, next(memory) if memory is not None else 0)
+              if not admission.admit(pending[1]):
+                break
+              batch, estimate = [pending[0]], pending[1]
+              pending = None
+              admission.start(estimate)
+            else:
+              batch = list(itertools.islice(settings, _batchSize(status.nbDone, status.duration, nbSettings-nbDispatched, nbJobs)))
+            put = lambda result, estimate=estimate: results.put((result, estimate))
+            if backend == 'process':
+              pool.apply_async(_doBatch, (batch,), callback=put, error_callback=put)
             else:
-                print(setting)
-            delay = (time.time()-stepTime)
-            if mailInterval>0 and iSetting<len(self)-1  and delay/(60**2) > mailInterval :
-              stepTime = time.time()
-              percentage = int((iSetting+1)/len(self)*100)
-              message = '{}% of settings done: {} over {} <br>Time elapsed: {}'.format(percentage, iSetting+1, len(self), time.strftime('%dd %Hh %Mm %Ss', time.gmtime(stepTime-startTime)))
-              experiment.sendMail('progress {}% '.format(percentage), message)
-            t.update(1)
-    return nbFailed
+              pool.apply_async(_runBatch, (self, batch, function, experiment, logFileName, parameters, options), callback=put, error_callback=put)
+            nbDispatched += len(batch)
+            nbBatches += 1
+          if not nbBatches:
+            break
+          # the batches beyond one per job are waiting for a job
+          status.running(min(nbBatches, nbJobs))
+          try:
+            # the admission of the pending setting is checked again periodically, as the load of the system evolves
+            result, estimate = results.get(timeout=1 if admission else None)
+          except queue.Empty:
+            continue
+          nbBatches -= 1
+          if admission:
+            admission.stop(estimate)
+          if isinstance(result, BaseException):
+            raise result
+          status.update(result[1], result[0], result[2], result[3])
+    else:
+      for setting in (self if done is None else (setting for setting, settingDone in zip(self, done) if not settingDone)):
+        if status.aborted():
+          break
+        status.running(1, str(setting))
+        startTime = time.time()
+        failed = 0
+        if function:
+          failed = setting.do(function, experiment, logFileName, *parameters, **options)
+        else:
+          print(setting)
+        if failed is None:
+          status.update(0, nbSkipped=1)
+        else:
+          status.update(1, failed, time.time()-startTime)
+
+  async def __doAsync__(self, settings, nbSettings, function, experiment, logFileName, parameters, nbJobs, status, options):
+    # nbJobs coroutines share the iterator over the settings, so that at most nbJobs settings are in flight
+    async def worker():
+      for setting in settings:
+        if status.aborted():
+          break
+        status.running(status.nbRunning+1)
+        startTime = time.time()
+        failed = await es.Setting(self, setting).doAsync(function, experiment, logFileName, *parameters, **options)
+        status.nbRunning -= 1
+        if failed is None:
+          status.update(0, nbSkipped=1)
+        else:
+          status.update(1, failed, time.time()-startTime)
+    await asyncio.gather(*[worker() for job in range(min(nbJobs, nbSettings))])
 
   def mask(
     self,
     mask=None,
-    volatile=False
+    volatile=False,
+    lazy=None
     ):
     """set the mask.
 
@@ -220,14 +692,21 @@ class Factor():
   	Parameters
   	----------
 
-    mask: list of list of int or list of int
-     a :term:`mask
+    mask: list of list of int or list of int or numpy array of bool
+     a :term:`mask`, or a selection of settings returned by :meth:`~explanes.factor.Factor.compileMask`. A setting reachable by several rows of the mask is browsed only once.
 
     volatile: bool
       if True, the mask is disabled after a complete iteration over the setting set.
 
       If False, the mask is saved for further iterations.
 
+    lazy: bool or None (optional)
+      if True, the setting set is never materialized: each setting is decoded on the fly from a running counter and the number of settings is computed from the mask. Memory usage is then constant whatever the size of the setting set.
+
+      If False, the setting set is expanded as an index matrix before iteration.
+
+      If None, the current mode is kept (default).
+
   	Examples
   	--------
 
@@ -265,6 +744,18 @@ class Factor():
     f1 a f2 3
     f1 b f2 2
     f1 b f2 3
+    >>> # a setting reachable by several masks is browsed once, where it is first reached
+    >>> for setting in f.mask([[[0, 2], [1, 2, 0]], [2], []]):
+    ...  print(setting)
+    f1 a f2 2
+    f1 a f2 3
+    f1 a f2 1
+    f1 c f2 2
+    f1 c f2 3
+    f1 c f2 1
+    f1 b f2 1
+    f1 b f2 2
+    f1 b f2 3
     >>> # if volatile is set to False (default) when the mask is set and the setting set iterated, the setting set stays ready for another iteration.
     >>> for setting in f.mask([0, 1]):
     ...  pass
@@ -299,12 +790,169 @@ class Factor():
     f1 c f2 1
     f1 c f2 2
     f1 c f2 3
+    >>> # very large setting sets can be browsed without being expanded in memory
+    >>> f.f3 = list(range(10**4))
+    >>> f.f4 = list(range(10**4))
+    >>> print(len(f.mask([2, [0, 2]], lazy=True)))
+    200000000
+    >>> for setting in f.mask([2, [0, 2], 5, [7, 8]]):
+    ...  print(setting)
+    f1 c f2 1 f3 5 f4 7
+    f1 c f2 1 f3 5 f4 8
+    f1 c f2 3 f3 5 f4 7
+    f1 c f2 3 f3 5 f4 8
     """
 
     self._mask = mask
     self._maskVolatile = volatile
+    self._slices = ()
+    if lazy is not None:
+      self._lazy = lazy
     return self
 
+  def compileMask(
+    self,
+    mask=None
+    ):
+    """returns the selection of settings defined by a mask as a boolean array.
+
+  	Returns the selection of settings defined by a :term:`mask` as a boolean numpy array with one dimension per factor, the size of each dimension being the number of modalities of the corresponding factor. Selections can be combined with the numpy logical operators (| for union, & for intersection, & ~ for difference) and given back to :meth:`~explanes.factor.Factor.mask`. The settings of a selection are browsed in the order of definition of the factors and of the modalities.
+
+  	Parameters
+  	----------
+
+    mask: list of list of int or list of int or numpy array of bool
+     a :term:`mask`. If None, select all the settings (default).
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.f1=['a', 'b', 'c']
+    >>> f.f2=[1, 2, 3]
+
+    >>> first = f.compileMask([[0, 1], [0, 1], -1])
+    >>> second = f.compileMask([[1, 2], [1, 2], -1])
+    >>> print(second.astype(int))
+    [[0 0 0]
+     [0 1 1]
+     [0 1 1]]
+    >>> for setting in f.mask(first & ~second):
+    ...  print(setting)
+    f1 a f2 1
+    f1 a f2 2
+    f1 b f2 1
+    >>> print(len(f.mask(first | second)))
+    7
+    >>> # overlapping rows of a mask do not lead to duplicate settings
+    >>> print(len(f.mask([[[0, 1], [0, 1]], [[1, 2], [1, 2]]])))
+    7
+    """
+    grid = [self.__nbModalities__(f) for f in self.factors()]
+    if isinstance(mask, np.ndarray):
+      if mask.size != math.prod(grid):
+        print('The selection should have one item per setting ('+str(math.prod(grid))+'). Got '+str(mask.size)+'.')
+        raise ValueError
+      return mask.astype(bool).reshape(grid)
+    selection = np.zeros(grid, dtype=bool)
+    for row in self.__maskRows__(mask):
+      selection[np.ix_(*row)] = True
+    return selection
+
+  def constraint(
+    self,
+    predicate=None
+    ):
+    """adds a constraint that discards the settings with meaningless combinations of modalities.
+
+  	Adds a constraint to the Factor object. Constraints are evaluated on the whole setting set before iteration, so that the settings that do not satisfy every constraint are never browsed nor counted.
+
+  	Parameters
+  	----------
+
+    predicate: function(values) or None
+      a function that takes a NameSpace where each member is a factor whose value is a numpy array of the modalities of this factor for a batch of settings, and returns a numpy array of bool, True for the valid settings.
+
+      If None, all the constraints are removed (default).
+
+    In lazy mode, the validity of each setting reachable by the mask is stored as one byte.
+
+  	See Also
+  	--------
+
+    explanes.factor.Factor.exclude
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.method = ['a', 'b']
+    >>> f.alpha = [0, 1, 2]
+    >>> f.beta = [0, 1]
+
+    >>> # alpha is only relevant to method a, and beta to method b
+    >>> f.constraint(lambda s: (s.method == 'a') | (s.alpha == 0))
+    >>> f.constraint(lambda s: (s.method == 'b') | (s.beta == 0))
+    >>> print(len(f))
+    5
+    >>> for setting in f:
+    ...   print(setting)
+    method a alpha 0 beta 0
+    method a alpha 1 beta 0
+    method a alpha 2 beta 0
+    method b alpha 0 beta 0
+    method b alpha 0 beta 1
+    >>> f.constraint()
+    >>> print(len(f))
+    12
+    """
+    if predicate is None:
+      self._constraints = []
+    else:
+      self._constraints = self._constraints+[predicate]
+
+  def exclude(
+    self,
+    **modalities
+    ):
+    """discards the settings with a given combination of modalities.
+
+  	Adds a constraint to the Factor object that discards every setting where each factor given as keyword argument has the given modality, or one of the modalities if a list is given.
+
+  	See Also
+  	--------
+
+    explanes.factor.Factor.constraint
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.method = ['a', 'b']
+    >>> f.alpha = [0, 1, 2]
+
+    >>> f.exclude(method='b', alpha=[1, 2])
+    >>> for setting in f:
+    ...   print(setting)
+    method a alpha 0
+    method a alpha 1
+    method a alpha 2
+    method b alpha 0
+    """
+    for factor, modality in modalities.items():
+      if factor not in self.factors():
+        print('Please set the factor '+factor+' before excluding some of its modalities.')
+        raise ValueError
+      if not isinstance(modality, list) and not isinstance(modality, np.ndarray):
+        modalities[factor] = [modality]
+    self.constraint(_Exclusion(modalities))
+
   def factors(
     self
     ):
@@ -361,23 +1009,510 @@ class Factor():
       factor = self.factors()[factor]
     return len(object.__getattribute__(self, factor))
 
+  def setting(
+    self,
+    index
+    ):
+    """returns the :term:`setting` at a given position of the setting set.
+
+  	Returns the :term:`setting` at a given position of the setting set defined by the current mask as a :class:`~explanes.setting.Setting` object. The setting is decoded directly from its position, without browsing the setting set. Slicing the Factor object with factor[start:stop:step] returns a view on a part of the setting set, without copying it.
+
+  	Parameters
+  	----------
+
+    index: int
+      the position of the setting in the setting set, negative values count from the end.
+
+  	See Also
+  	--------
+
+    explanes.setting.index
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.f1 = ['a', 'b', 'c']
+    >>> f.f2 = [1, 2, 3]
+
+    >>> print(f.setting(4))
+    f1 b f2 2
+    >>> print(f.mask([[1, 2], -1]).setting(-1))
+    f1 c f2 3
+    >>> print(el.setting.index(f.setting(-1)))
+    5
+    >>> for setting in f.mask()[1::4]:
+    ...   print(setting)
+    f1 a f2 2
+    f1 b f2 3
+    >>> print(len(f[2:]))
+    7
+    """
+    positions = self.__positions__()
+    return es.Setting(self, self.__decodeSetting__(positions[index]))
+
+  def ids(
+    self,
+    format='long',
+    sort=True,
+    separator='_',
+    singleton=True,
+    default=False,
+    hide=[]
+    ):
+    """returns the ids of all the settings of the setting set.
+
+  	Returns the ids of all the settings of the setting set defined by the current mask as a list, in the order of iteration. The ids are built at once by concatenating arrays of the compressed names of the factors and modalities, which is much faster than calling :meth:`explanes.setting.Setting.id` for each setting.
+
+  	Parameters
+  	----------
+
+    format, sort, separator, singleton, default, hide:
+      encoding of the ids. Please refer to :meth:`explanes.setting.Setting.id` for further information.
+
+  	See Also
+  	--------
+
+    explanes.setting.Setting.id
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.one = ['a', 'b']
+    >>> f.two = [0, 1]
+    >>> f.default('two', 0)
+
+    >>> print(f.ids())
+    ['one_a', 'one_a_two_1', 'one_b', 'one_b_two_1']
+    >>> print(f.mask([1]).ids(format='list', default=True))
+    [['one', 'b', 'two', '0'], ['one', 'b', 'two', '1']]
+    >>> print(f.mask([1, 1]).ids(format='hash'))
+    ['...']
+    """
+    if isinstance(hide, str) or isinstance(hide, int):
+      hide = (hide,)
+    settings = self.__settingMatrix__()
+    # one column per displayed factor gathering the description of the modality of each setting, each factor/modality couple being prefixed by the separator
+    columns = []
+    for fi, factorToken, modalityTokens in self.__idTokens__(format, sort, singleton, default, tuple(hide)):
+      if 'list' in format:
+        pieces = [(factorToken, m) if m is not None else () for m in modalityTokens]
+      else:
+        pieces = [separator+factorToken+separator+m if m is not None else '' for m in modalityTokens]
+      column = np.empty(len(pieces), dtype=object)
+      for pi, piece in enumerate(pieces):
+        column[pi] = piece
+      columns.append(column[settings[:, fi]].tolist())
+    if not columns:
+      columns = [[()]*len(settings)] if 'list' in format else [['']*len(settings)]
+
+    if 'list' in format:
+      return [[token for piece in setting for token in piece] for setting in zip(*columns)]
+    ids = [''.join(setting)[len(separator):] for setting in zip(*columns)]
+    if format == 'hash':
+      md5 = hashlib.md5
+      ids = [md5(id).hexdigest() for id in map(str.encode, ids)]
+    return ids
+
+  def idIndex(
+    self,
+    format='long',
+    sort=True,
+    separator='_',
+    singleton=True,
+    default=False,
+    hide=[]
+    ):
+    """returns a dict mapping the id of each setting of the setting set to its position.
+
+  	Returns a dict mapping the id of each setting of the setting set defined by the current mask to its position in this set, so that the setting corresponding to an id is retrieved in constant time with :meth:`explanes.factor.Factor.setting`.
+
+  	Parameters
+  	----------
+
+    format, sort, separator, singleton, default, hide:
+      encoding of the ids. Please refer to :meth:`explanes.setting.Setting.id` for further information. The 'list' format is not supported.
+
+  	See Also
+  	--------
+
+    explanes.factor.Factor.ids, explanes.factor.Factor.setting
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.one = ['a', 'b']
+    >>> f.two = [0, 1]
+
+    >>> index = f.idIndex()
+    >>> print(index)
+    {'one_a_two_0': 0, 'one_a_two_1': 1, 'one_b_two_0': 2, 'one_b_two_1': 3}
+    >>> print(f.setting(index['one_b_two_0']))
+    one b two 0
+    >>> index = f.idIndex(format='hash')
+    >>> print(f.setting(index[f.setting(3).id(format='hash')]))
+    one b two 1
+    """
+    if 'list' in format:
+      print('The list format cannot be used to index the settings.')
+      raise ValueError
+    return {id: position for position, id in enumerate(self.ids(format, sort, separator, singleton, default, hide))}
+
+  def manifest(
+    self,
+    path,
+    settingEncoding={}
+    ):
+    """writes the description of the settings of the setting set in the manifest of a data sink.
+
+  	The manifest of a data sink (directory or .h5 file) maps the id of each setting stored in the data sink to the modality of each factor of this setting. It allows to go from the entries of the data sink back to the settings, even for hashed ids. The manifest is filled as the settings are run by :meth:`explanes.experiment.Experiment.do`. This method adds the settings of the setting set defined by the current mask that are not yet in the manifest, for example to describe settings whose data were stored by other means.
+
+  	Parameters
+  	----------
+
+    path: str
+      path to the data sink.
+
+    settingEncoding : dict (optional)
+      format of the id describing the :term:`setting`. Please refer to :meth:`explanes.setting.Setting.id` for further information.
+
+  	Returns
+  	-------
+
+    manifest: dict
+      the updated manifest.
+
+  	See Also
+  	--------
+
+    explanes.util.readManifest, explanes.factor.Factor.scanDataSink
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+    >>> import shutil
+    >>> import os
+
+    >>> f = el.factor.Factor()
+    >>> f.one = ['a', 'b']
+    >>> f.two = [0, 1]
+    >>> shutil.rmtree('/tmp/testManifest', ignore_errors=True)
+    >>> os.makedirs('/tmp/testManifest')
+
+    >>> manifest = f.mask([1]).manifest('/tmp/testManifest', {'format': 'hash'})
+    >>> print(manifest[f.mask().setting(3).id(format='hash')])
+    {'one': 'b', 'two': 1}
+    >>> print(len(el.util.readManifest('/tmp/testManifest')))
+    2
+    """
+    path = os.path.expanduser(path)
+    manifest = eu.readManifest(path)
+    factors = self.factors()
+    modalities = [self.__modalityArray__(f).tolist() for f in factors]
+    # the records of the missing settings are appended to the manifest
+    with open(eu.manifestPath(path), 'a') as file:
+      for id, setting in zip(self.ids(**settingEncoding), self.__settingMatrix__().tolist()):
+        if id not in manifest:
+          manifest[id] = {f: modalities[fi][setting[fi]] for fi, f in enumerate(factors)}
+          file.write(json.dumps({'id': id, 'setting': manifest[id]}, default=str)+'\n')
+    return manifest
+
+  def scanDataSink(
+    self,
+    path,
+    settingEncoding={}
+    ):
+    """returns the id of the setting of each entry of a data sink.
+
+  	Lists the entries of a data sink, that is the files of a directory or the groups of a .h5 file, at once, and classifies each entry by looking up its id in a dict built from the ids of the setting set and the manifest of the data sink. The id of the setting of a file is the longest known id that prefixes the name of the file.
+
+  	Parameters
+  	----------
+
+    path: str
+      path to the data sink.
+
+    settingEncoding : dict (optional)
+      format of the id describing the :term:`setting`. Please refer to :meth:`explanes.setting.Setting.id` for further information.
+
+  	Returns
+  	-------
+
+    entries: dict
+      maps the name of each entry of the data sink to the id of its setting, or to None if the entry can not be classified.
+
+  	See Also
+  	--------
+
+    explanes.factor.Factor.manifest
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+    >>> import numpy as np
+    >>> import shutil
+    >>> import os
+
+    >>> f = el.factor.Factor()
+    >>> f.one = ['a', 'b']
+    >>> f.two = [0, 1]
+    >>> shutil.rmtree('/tmp/testScan', ignore_errors=True)
+    >>> os.makedirs('/tmp/testScan')
+    >>> for setting in f:
+    ...   np.save('/tmp/testScan/'+setting.id()+'_metric.npy', 0)
+    >>> np.save('/tmp/testScan/unknown.npy', 0)
+
+    >>> entries = f.mask([0]).scanDataSink('/tmp/testScan')
+    >>> print(sorted(entries.items(), key=str))
+    [('one_a_two_0_metric.npy', 'one_a_two_0'), ('one_a_two_1_metric.npy', 'one_a_two_1'), ('one_b_two_0_metric.npy', None), ('one_b_two_1_metric.npy', None), ('unknown.npy', None)]
+    >>> manifest = f.mask().manifest('/tmp/testScan')
+    >>> print(f.mask([0]).scanDataSink('/tmp/testScan')['one_b_two_0_metric.npy'])
+    one_b_two_0
+    """
+    path = os.path.expanduser(path)
+    ids = set(self.ids(**settingEncoding))
+    ids.update(eu.readManifest(path).keys())
+    if path.endswith('.h5'):
+      h5 = tb.open_file(path, mode='r')
+      entries = {g._v_name: g._v_name if g._v_name in ids else None for g in h5.iter_nodes('/')}
+      h5.close()
+      return entries
+    # as for a glob, hidden files are not considered
+    lengths = sorted(set(len(id) for id in ids), reverse=True)
+    entries = {}
+    for name in os.listdir(path):
+      if not name.startswith('.'):
+        entries[name] = next((name[:length] for length in lengths if name[:length] in ids), None)
+    return entries
+
+  def done(
+    self,
+    path,
+    metrics,
+    settingEncoding={}
+    ):
+    """returns which settings of the setting set have all their metrics stored in a data sink.
+
+  	The data sink is scanned once, by listing the directory for .npy storage, where the metric of a setting is stored in the file <id_of_setting>_<metricName>.npy, or by listing the groups of the .h5 file and their children. The completion of each setting is then checked by lookups in this index.
+
+  	Parameters
+  	----------
+
+    path: str
+      path to the data sink.
+
+    metrics: list of str
+      names of the metrics that should be available for a setting to be considered as done. If empty, no setting is considered as done.
+
+    settingEncoding : dict (optional)
+      format of the id describing the :term:`setting`. Please refer to :meth:`explanes.setting.Setting.id` for further information.
+
+  	Returns
+  	-------
+
+    done: ndarray of bool
+      True for each setting of the setting set, in the order of iteration, whose metrics are all available.
+
+  	See Also
+  	--------
+
+    explanes.factor.Factor.do
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+    >>> import numpy as np
+    >>> import shutil
+    >>> import os
+
+    >>> f = el.factor.Factor()
+    >>> f.one = ['a', 'b']
+    >>> f.two = [0, 1]
+    >>> shutil.rmtree('/tmp/testDone', ignore_errors=True)
+    >>> os.makedirs('/tmp/testDone')
+    >>> for setting in f.mask([0]):
+    ...   np.save('/tmp/testDone/'+setting.id()+'_mse.npy', 0)
+    ...   np.save('/tmp/testDone/'+setting.id()+'_duration.npy', 0)
+    >>> np.save('/tmp/testDone/one_b_two_0_mse.npy', 0)
+
+    >>> print(f.mask().done('/tmp/testDone', ['mse', 'duration']))
+    [ True  True False False]
+    >>> print(f.done('/tmp/testDone', ['mse']))
+    [ True  True  True False]
+    """
+    path = os.path.expanduser(path)
+    if not metrics or not path or not os.path.exists(path):
+      return np.zeros(len(self), dtype=bool)
+    if path.endswith('.h5'):
+      h5 = tb.open_file(path, mode='r')
+      entries = {g._v_name: set(g._v_children) for g in h5.iter_nodes('/', classname='Group')}
+      h5.close()
+      return np.array([id in entries and all(m in entries[id] for m in metrics) for id in self.ids(**settingEncoding)], dtype=bool)
+    entries = set(os.listdir(path))
+    return np.array([all(id+'_'+m+'.npy' in entries for m in metrics) for id in self.ids(**settingEncoding)], dtype=bool)
+
+  def shard(
+    self,
+    index,
+    nbShards,
+    costs=None
+    ):
+    """returns which settings of the setting set belong to a shard.
+
+  	Partitions the setting set into nbShards shards and returns the membership of the shard index. The partition is deterministic, so that independent processes, possibly on different hosts, that consider the same setting set and costs compute the same partition and together process every setting exactly once.
+
+  	Parameters
+  	----------
+
+    index: int
+      index of the shard, between 0 and nbShards-1.
+
+    nbShards: int
+      number of shards.
+
+    costs: ndarray of float or None (optional)
+      cost of each setting of the setting set, for example predicted with :meth:`explanes.factor.Factor.predictCost`.
+
+      If None, the settings are assigned to the shards in turn (default).
+
+      If not None, each setting is assigned, by decreasing cost, to the shard with the lowest total cost.
+
+  	Returns
+  	-------
+
+    shard: ndarray of bool
+      True for each setting of the setting set, in the order of iteration, that belongs to the shard.
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.one = ['a', 'b', 'c']
+    >>> f.two = [0, 1]
+
+    >>> print(f.shard(0, 2))
+    [ True False  True False  True False]
+    >>> print(f.shard(0, 2, costs=[6, 5, 4, 3, 2, 1]))
+    [ True False False  True  True False]
+    """
+    if index < 0 or index >= nbShards:
+      print('The index of the shard should be between 0 and '+str(nbShards-1)+'.')
+      raise ValueError
+    if costs is None:
+      return np.arange(len(self)) % nbShards == index
+    shards = np.empty(len(self), dtype=int)
+    # longest processing time first assignment to the least loaded shard
+    loads = [(0, s) for s in range(nbShards)]
+    for position in np.argsort(-np.asarray(costs), kind='stable'):
+      load, s = heapq.heappop(loads)
+      shards[position] = s
+      heapq.heappush(loads, (load+costs[position], s))
+    return shards == index
+
+  def predictCost(
+    self,
+    durations,
+    settingEncoding={}
+    ):
+    """returns the predicted cost of each setting of the setting set.
+
+  	The cost of a setting is its duration if known. Otherwise, it is predicted with a multiplicative model where each modality of each factor scales the cost, the scalings being fitted by least squares on the logarithm of the known durations. If no duration is known, every setting has a cost of 1.
+
+  	Any other positive measure known for some settings, such as the peak memory given by :meth:`explanes.util.readMeasures`, can be predicted the same way.
+
+  	Parameters
+  	----------
+
+    durations: dict
+      maps the id of settings to their durations, as given by :meth:`explanes.util.readDurations`.
+
+    settingEncoding : dict (optional)
+      format of the id describing the :term:`setting`. Please refer to :meth:`explanes.setting.Setting.id` for further information.
+
+  	Returns
+  	-------
+
+    costs: ndarray of float
+      the cost of each setting of the setting set, in the order of iteration.
+
+  	See Also
+  	--------
+
+    explanes.factor.Factor.do, explanes.util.readDurations
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.size = [1, 10]
+    >>> f.method = ['a', 'b']
+
+    >>> print(f.predictCost({'method_a_size_1': 1, 'method_b_size_1': 2, 'method_a_size_10': 10}))
+    [ 1.  2. 10. 20.]
+    >>> f.size = [1, 10, 100]
+    >>> print(f.predictCost({'method_a_size_1': 1, 'method_b_size_1': 2, 'method_a_size_10': 10}).round(2))
+    [ 1.    2.   10.   20.    3.16  6.32]
+    """
+    ids = self.ids(**settingEncoding)
+    settings = self.__settingMatrix__()
+    costs = np.array([durations.get(id, np.nan) for id in ids], dtype=float)
+    known = ~np.isnan(costs)
+    if not np.any(known):
+      return np.ones(len(ids))
+    # one column per modality of each factor, the first column being the intercept
+    offsets = np.cumsum([1]+[self.__nbModalities__(f) for f in self.factors()])
+    design = np.zeros((np.count_nonzero(known), offsets[-1]))
+    design[:, 0] = 1
+    for fi in range(len(self.factors())):
+      design[np.arange(len(design)), offsets[fi]+settings[known, fi]] = 1
+    effects = np.linalg.lstsq(design, np.log(np.maximum(costs[known], 1e-9)), rcond=None)[0]
+    # a modality without known durations is given the mean effect of the other modalities of its factor
+    observed = design.any(axis=0)
+    for fi in range(len(self.factors())):
+      factorObserved = observed[offsets[fi]:offsets[fi+1]]
+      effects[offsets[fi]:offsets[fi+1]][~factorObserved] = np.mean(effects[offsets[fi]:offsets[fi+1]][factorObserved])
+    prediction = np.full(np.count_nonzero(~known), effects[0])
+    for fi in range(len(self.factors())):
+      prediction += effects[offsets[fi]+settings[~known, fi]]
+    costs[~known] = np.exp(prediction)
+    return costs
+
   def cleanH5(self, path, reverse=False, force=False, settingEncoding={}):
     """clean a h5 data sink by considering the settings set.
 
   	This method is more conveniently used by considering the method :meth:`explanes.experiment.Experiment.cleanDataSink, please see its documentation for usage.
     """
     h5 = tb.open_file(path, mode='a')
+    removed = []
     if reverse:
-      ids = [setting.id(**settingEncoding) for setting in self]
+      ids = set(self.ids(**settingEncoding))
       for g in h5.iter_nodes('/'):
         if g._v_name not in ids:
+          removed.append(g._v_name)
           h5.remove_node(h5.root, g._v_name, recursive=True)
     else:
-      for setting in self:
-        groupName = setting.id(**settingEncoding)
+      for groupName in self.ids(**settingEncoding):
         if h5.root.__contains__(groupName):
           h5.remove_node(h5.root, groupName, recursive=True)
+          removed.append(groupName)
     h5.close()
+    # the removed settings can be claimed again
+    eu.forget(path, removed)
 
     # repack
     outfilename = path+'Tmp'
@@ -408,18 +1543,16 @@ class Factor():
     if path.endswith('.h5'):
       self.cleanH5(path, reverse, force, settingEncoding)
     else:
+      ids = set(self.ids(**settingEncoding))
       fileNames = []
-      for setting in self:
-        print(path+'/'+setting.id(**settingEncoding)+selector)
-        for f in glob.glob(path+'/'+setting.id(**settingEncoding)+selector):
-            fileNames.append(f)
-      if reverse:
-        complete = []
-        for f in glob.glob(path+'/'+selector):
-          complete.append(f)
-        # print(fileNames)
-        fileNames = [i for i in complete if i not in fileNames]
-      #   print(complete)
+      removed = set()
+      for name, id in self.scanDataSink(path, settingEncoding).items():
+        selected = id in ids and fnmatch.fnmatch(name[len(id):], selector)
+        if reverse:
+          selected = not selected and fnmatch.fnmatch(name, selector)
+        if selected:
+          fileNames.append(path+'/'+name)
+          removed.add(id)
       fileNames = set(fileNames)
       print(fileNames)
       # print(len(fileNames))
@@ -433,48 +1566,103 @@ class Factor():
             os.rename(f, archivePath+'/'+os.path.basename(f))
           else:
             os.remove(f)
+        # the settings whose data is removed can be claimed again
+        eu.forget(path, removed)
 
   def merge(self):
-    # build temporary factor
-    tmp = Factor()
+    """returns a Factor object that merges the factors of the sub experiments.
+
+  	Each member of the Factor object is considered as a sub experiment, that is a Factor object. The returned Factor object has the union of the factors of the sub experiments, each factor having the union of the modalities of this factor in the sub experiments, in order of appearance. A factor that is not defined in every sub experiment gets a default modality, 'none' or 0 if not specified, and the setting set is restricted to the settings of the sub experiments using :meth:`explanes.factor.Factor.constraint`.
+
+  	The modalities of each factor are gathered in a dict that indexes each modality, so that merging is linear in the total number of modalities.
+
+  	Examples
+  	--------
+
+    >>> import explanes as el
+
+    >>> f = el.factor.Factor()
+    >>> f.xp1 = el.factor.Factor()
+    >>> f.xp1.method = ['methodOne']
+    >>> f.xp1.parameterOne = ['a', 'b']
+    >>> f.xp2 = el.factor.Factor()
+    >>> f.xp2.method = ['methodTwo']
+    >>> f.xp2.parameterTwo = [1, 2]
+
+    >>> m = f.merge()
+    >>> print(m)
+      0  method: ['methodOne', 'methodTwo']
+      1  parameterOne: ['none', 'a', 'b']
+      2  parameterTwo: [0, 1, 2]
+    >>> for setting in m:
+    ...   print(setting.id())
+    method_methodOne_parameterOne_a
+    method_methodOne_parameterOne_b
+    method_methodTwo_parameterTwo_1
+    method_methodTwo_parameterTwo_2
+
+    >>> # modalities that can not be hashed, such as lists, are compared by equality
+    >>> f = el.factor.Factor()
+    >>> f.xp1 = el.factor.Factor()
+    >>> f.xp1.shape = [[1, 2], [3]]
+    >>> f.xp2 = el.factor.Factor()
+    >>> f.xp2.shape = [[3], [4, 5]]
+    >>> f.xp2.gain = [1, 2]
+    >>> m = f.merge()
+    >>> print(m)
+      0  shape: [[1, 2], [3], [4, 5]]
+      1  gain: [0, 1, 2]
+    >>> for setting in m:
+    ...   print(setting.id())
+    shape_[1, 2]
+    shape_[3]
+    gain_1_shape_[3]
+    gain_2_shape_[3]
+    gain_1_shape_[4, 5]
+    gain_2_shape_[4, 5]
+    """
+    # ordered set of the modalities of each factor
+    modalities = {}
+    defaults = {}
+    nbExperiments = {}
     for x in self.factors():
-      for f in getattr(self, x).factors():
-        setattr(tmp, f, [])
-        if hasattr(getattr(self, x)._default, f):
-          if hasattr(tmp._default, f) and getattr(getattr(self, x)._default, f) != getattr(tmp._default, f):
-            print(getattr(tmp._default, f))
+      xFactor = getattr(self, x)
+      for f in xFactor.factors():
+        index = modalities.setdefault(f, _Modalities())
+        xModalities = getattr(xFactor, f)
+        if not isinstance(xModalities, list) and not isinstance(xModalities, np.ndarray):
+          xModalities = [xModalities]
+        for m in xModalities:
+          index.add(m)
+        nbExperiments[f] = nbExperiments.get(f, 0)+1
+        if hasattr(xFactor._default, f):
+          if f in defaults and getattr(xFactor._default, f) != defaults[f]:
+            print(defaults[f])
             print('While merging factors of the different experiment, a conflict of default modalities for the factor '+f+' is detected. This may lead to an inconsistent behavior.')
             raise ValueError
-          else:
-            setattr(tmp._default, f, getattr(getattr(self, x)._default, f))
-            # print(tmp._default)
-    for x in self.factors():
-      for f in getattr(self, x).factors():
-        for m in getattr(getattr(self, x), f):
-          if m not in getattr(tmp, f):
-            getattr(tmp, f).append(m)
-    # check if factors are available in every experiment
-    have = [True]*len(tmp.factors())
-    for fi, f in enumerate(tmp.factors()):
-      for x in self.factors():
-        if not f in getattr(self, x).factors():
-          have[fi] = False
-    # print(have)
+          defaults[f] = getattr(xFactor._default, f)
+
     factor = Factor()
-    factor._default = tmp._default
-    for fi, f in enumerate(tmp.factors()):
-      m = getattr(tmp, f)
-      setattr(factor, f, m)
-      if not have[fi] and not hasattr(tmp._default, f):
+    for f, index in modalities.items():
+      m = list(index)
+      # factors not available in every experiment get a default modality
+      if nbExperiments[f] < len(self.factors()) and f not in defaults:
         if isinstance(m[0], str):
-          if'none' not in m:
+          if 'none' not in index:
             m.insert(0, 'none')
-          factor.default(f, 'none')
-        if not isinstance(m[0], str):
-          if 0 not in m:
+          defaults[f] = 'none'
+        else:
+          if 0 not in index:
             m.insert(0, 0)
-          factor.default(f, 0)
+          defaults[f] = 0
       setattr(factor, f, m)
+    for f, modality in defaults.items():
+      setattr(factor._default, f, modality)
+    # a setting is valid if it belongs to one of the experiments, the factors not defined in this experiment being set to their default modality
+    experiments = []
+    for x in self.factors():
+      experiments.append({f: getattr(self, x).__modalityArray__(f) if f in getattr(self, x).factors() else [getattr(factor._default, f)] for f in factor.factors()})
+    factor.constraint(_Membership(experiments))
     return factor
 
   def asPandaFrame(self):
@@ -539,12 +1727,20 @@ class Factor():
     name,
     value
     ):
+    # fast path for the private bookkeeping attributes, set for each setting during iteration
+    if name[0] == '_' and name not in _trackedAttributes:
+      return object.__setattr__(self, name, value)
     if not hasattr(self, name) and name[0] != '_':
+      if hasattr(es.Setting, name):
+        raise Exception('the factor '+name+' is shadowing a method of explanes.setting.Setting')
+      self._factorPositions[name] = len(self._factors)
       self._factors.append(name)
     if hasattr(self, name) and type(inspect.getattr_static(self, name)) == types.FunctionType:
       raise Exception('the attribute '+name+' is shadowing a builtin function')
-    if name == '_mask' or name[0] != '_':
+    if name in ['_mask', '_lazy', '_constraints'] or name[0] != '_':
       self._changed = True
+    if name == '_default' or name[0] != '_':
+      self._idTokens = {}
     if name[0] != '_' and type(value) in {list, np.ndarray} and len(value)>1 and name not in self._nonSingleton:
       self._nonSingleton.append(name)
     return object.__setattr__(self, name, value)
@@ -556,6 +1752,8 @@ class Factor():
     self._changed = True
     if hasattr(self, name) and name[0] != '_':
       self._factors.remove(name)
+      self._factorPositions = {f: fi for fi, f in enumerate(self._factors)}
+      self._idTokens = {}
       if name in self._nonSingleton:
         self._nonSingleton.remove(name)
     return object.__delattr__(self, name)
@@ -584,7 +1782,7 @@ class Factor():
     self
     ):
 
-    self.__setSettings__()
+    self._positions = self.__positions__()
     self._currentSetting = 0
     return self
 
@@ -592,106 +1790,339 @@ class Factor():
     self
     ):
 
-    if self._currentSetting == len(self._settings):
-      if self._maskVolatile:
+    if self._currentSetting == len(self._positions):
+      if self._maskVolatile and self._mask is not None:
         self._mask = None
       raise StopIteration
     else:
-      self._setting = self._settings[self._currentSetting]
-      # print(self._setting)
+      setting = self.__decodeSetting__(self._positions[self._currentSetting])
       self._currentSetting += 1
-      return es.Setting(self)
+      return es.Setting(self, setting)
       # if self._parallel:
       #   return copy.deepcopy(self)
       # else:
       #   return self #  copy.deepcopy(self)
 
   def __getitem__(self, index):
-    # print('get item')
-    self.__setSettings__()
-    # print(self._mask)
-    return  self
-
+    if isinstance(index, slice):
+      self.__setSettings__()
+      view = copy.copy(self)
+      view._slices = self._slices+(index,)
+      view._maskVolatile = False
+      return view
+    return self.setting(index)
 
   def __len__(
     self
     ):
+    return len(self.__positions__())
+
+  def __positions__(self):
+    # positions in the setting set of the settings reachable through the slices of the view
     self.__setSettings__()
-    return len(self._settings)
+    positions = range(self._nbSettings)
+    for s in self._slices:
+      positions = positions[s]
+    return positions
+
+  def __idTokens__(self, format, sort, singleton, default, hide):
+    # for a given encoding, returns the ordered list of the displayed factors as tuples (position of the factor, compressed name of the factor, compressed name of each modality or None if the modality is not displayed)
+    key = (format, sort, singleton, default, hide)
+    if key not in self._idTokens:
+      fNames = self._factors
+      hide = [fNames[h] if isinstance(h, int) else h for h in hide]
+      if sort:
+        fNames = sorted(fNames)
+      tokens = []
+      for f in fNames:
+        if f not in hide and (singleton or f in self._nonSingleton):
+          modalities = getattr(self, f)
+          if not isinstance(modalities, list) and not isinstance(modalities, np.ndarray):
+            modalities = [modalities]
+          hideDefault = not default and hasattr(self._default, f)
+          modalityTokens = []
+          for m in modalities:
+            if m is None or (hideDefault and getattr(self._default, f) == m):
+              modalityTokens.append(None)
+            else:
+              modalityTokens.append(eu.compressDescription(str(m), format))
+          tokens.append((self._factorPositions[f], eu.compressDescription(f, format), modalityTokens))
+      self._idTokens[key] = tokens
+    return self._idTokens[key]
 
   def __setSettings__(
     self
     ):
     if self._changed:
-      settings = []
-      mask = copy.deepcopy(self._mask)
       self._setting = None
-
-      mask = copy.deepcopy(mask)
+      self._settings = None
+      self._maskRows = None
+      self._maskRowIndexes = None
+      self._selection = None
+      self._selectionCounts = None
+      self._settingOffsets = [0]
       nbFactors = len(self.factors())
-      if mask is None or len(mask)==0 or (len(mask)==1 and len(mask)==0) :
-         mask = [[-1]*nbFactors]
-      if isinstance(mask, list) and not all(isinstance(x, list) for x in mask):
-          mask = [mask]
-
-      for im, m in enumerate(mask):
-        if len(m) < nbFactors:
-          mask[im] = m+[-1]*(nbFactors-len(m))
-        for il, l in enumerate(m):
-            if not isinstance(l, list) and l > -1:
-                mask[im][il] = [l]
-
-      for m in mask:
-        # handle -1 in mask
-        for mfi, mf in enumerate(m):
-          if isinstance(mf, int) and mf == -1 and mfi<len(self.factors()):
-            attr = self.__getattribute__(self.factors()
-            [mfi])
-            # print(attr)
-            # print(isinstance(attr, int))
-            if isinstance(attr, list) or isinstance(attr, np.ndarray):
-              m[mfi] = list(range(len(attr)))
-            else:
-              m[mfi] = [0]
-
-        s = self.__setSettingsMask__(m, 0)
-        if all(isinstance(ss, list) for ss in s):
-          for ss in s:
-            settings.append(ss)
+      if not nbFactors:
+        self._settings = np.empty((0, 0), dtype=np.int8)
+        self._nbSettings = 0
+        self._changed = False
+        return
+
+      # the settings are enumerated over the complete grid for a selection, or over the mask rows otherwise
+      if isinstance(self._mask, np.ndarray):
+        self._selection = self.compileMask(self._mask).reshape(-1)
+        self._settingOffsets.append(self._selection.size)
+      else:
+        self._maskRows = self.__disjointMaskRows__([[m.tolist() for m in row] for row in self.__maskRows__(self._mask)])
+        for row in self._maskRows:
+          self._settingOffsets.append(self._settingOffsets[-1]+math.prod(len(m) for m in row))
+      nbEnumerated = self._settingOffsets[-1]
+      if not self._lazy and self._selection is not None:
+        settings = self.__unravel__(np.flatnonzero(self._selection))
+      elif not self._lazy:
+        settings = np.concatenate([self.__setSettingsMask__([np.array(m) for m in row], self.__dtype__()) for row in self._maskRows]+[np.empty((0, nbFactors), dtype=self.__dtype__())])
+
+      if self._constraints and self._lazy:
+        if self._selection is None:
+          self._selection = np.ones(nbEnumerated, dtype=bool)
+        for c in range(0, nbEnumerated, _constraintChunkSize):
+          positions = c+np.flatnonzero(self._selection[c:c+_constraintChunkSize])
+          self._selection[positions] = self.__checkConstraints__(self.__decodeSettings__(positions))
+      elif self._constraints:
+        valid = np.ones(len(settings), dtype=bool)
+        for c in range(0, len(settings), _constraintChunkSize):
+          valid[c:c+_constraintChunkSize] = self.__checkConstraints__(settings[c:c+_constraintChunkSize])
+        if self._selection is None:
+          self._selection = valid
         else:
-          settings.append(s)
+          self._selection[np.flatnonzero(self._selection)[~valid]] = False
+        settings = settings[valid]
+
+      if self._selection is not None:
+        # number of selected settings before each chunk of the enumeration
+        self._selectionCounts = [0]
+        for c in range(0, nbEnumerated, _selectionChunkSize):
+          self._selectionCounts.append(self._selectionCounts[-1]+int(np.count_nonzero(self._selection[c:c+_selectionChunkSize])))
+        self._nbSettings = self._selectionCounts[-1]
+      else:
+        self._nbSettings = nbEnumerated
+      if not self._lazy:
+        self._settings = settings
       self._changed = False
-      self._settings = settings
 
-  def __setSettingsMask__(self, mask, done):
-    if done == len(mask):
-      return []
+  def __settingMatrix__(self):
+    # returns the index matrix of the settings reachable through the slices of the view, decoding them in lazy mode
+    positions = self.__positions__()
+    if self._settings is not None:
+      if self._slices:
+        return self._settings[np.arange(positions.start, positions.stop, positions.step)]
+      return self._settings
+    positions = np.arange(positions.start, positions.stop, positions.step)
+    if self._selection is not None:
+      positions = np.flatnonzero(self._selection)[positions]
+    return self.__decodeSettings__(positions)
+
+  def __settingChunks__(self, done=None):
+    # yields the index matrices of consecutive chunks of the settings reachable through the slices of the view, decoding them in lazy mode, leaving out the settings flagged in done
+    positions = self.__positions__()
+    for start in range(0, len(positions), _decodeChunkSize):
+      chunk = positions[start:start+_decodeChunkSize]
+      chunk = np.arange(chunk.start, chunk.stop, chunk.step)
+      if self._settings is not None:
+        settings = self._settings[chunk]
+      else:
+        if self._selection is not None:
+          chunk = self.__selectedPositions__(chunk)
+        settings = self.__decodeSettings__(chunk)
+      if done is not None:
+        settings = settings[~done[start:start+_decodeChunkSize]]
+      yield settings
+
+  def __selectedPositions__(self, positions):
+    # returns the positions in the enumeration of the settings at given positions of the selection
+    chunks = np.searchsorted(self._selectionCounts, positions, side='right')-1
+    selected = np.empty(len(positions), dtype=np.int64)
+    for chunk in np.unique(chunks):
+      where = chunks == chunk
+      flat = np.flatnonzero(self._selection[chunk*_selectionChunkSize:(chunk+1)*_selectionChunkSize])
+      selected[where] = chunk*_selectionChunkSize+flat[positions[where]-self._selectionCounts[chunk]]
+    return selected
+
+  def __decodeSettings__(self, positions):
+    # returns the index matrix of the settings at given positions of the enumeration
+    if self._maskRows is None:
+      return self.__unravel__(positions)
+    if len(positions) > 1 and np.any(positions[1:] < positions[:-1]):
+      order = np.argsort(positions)
+      settings = np.empty((len(positions), len(self.factors())), dtype=self.__dtype__())
+      settings[order] = self.__decodeSettings__(positions[order])
+      return settings
+    settings = np.empty((len(positions), len(self.factors())), dtype=self.__dtype__())
+    # the positions being sorted, the settings of each mask row are contiguous
+    bounds = np.searchsorted(positions, self._settingOffsets)
+    for row, mask in enumerate(self._maskRows):
+      if bounds[row] < bounds[row+1]:
+        flat = positions[bounds[row]:bounds[row+1]]-self._settingOffsets[row]
+        for mfi in range(len(mask)-1, -1, -1):
+          flat, modality = np.divmod(flat, len(mask[mfi]))
+          settings[bounds[row]:bounds[row+1], mfi] = np.array(mask[mfi])[modality]
+    return settings
 
-    s = self.__setSettingsMask__(mask, done+1)
-    if isinstance(mask[done], list):
-      settings = []
-      for mod in mask[done]:
-        if len(s) > 0:
-          for ss in s:
-            if isinstance(ss, list):
-                mList = list(ss)
-            else:
-                mList = [ss]
-            mList.insert(0, mod)
-            settings.append(mList)
-        else:
-          mList = list(s)
-          mList.insert(0, mod)
-          settings.append(mList)
+  def __decodeSetting__(self, index):
+    # returns the modality indexes of the setting at a given position of the setting set
+    if self._settings is not None:
+      return self._settings[index].tolist()
+    if self._selection is not None:
+      chunk = bisect.bisect_right(self._selectionCounts, index)-1
+      index = chunk*_selectionChunkSize+int(np.flatnonzero(self._selection[chunk*_selectionChunkSize:(chunk+1)*_selectionChunkSize])[index-self._selectionCounts[chunk]])
+    if self._maskRows is None:
+      mask = [range(self.__nbModalities__(f)) for f in self.factors()]
     else:
-      settings = s
-      if len(settings) > 0 and all(isinstance(ss, list) for ss in settings):
-        for ss in settings:
-          ss.insert(0, mask[done])
-      else:
-        settings.insert(0, mask[done])
+      row = bisect.bisect_right(self._settingOffsets, index)-1
+      mask = self._maskRows[row]
+      index -= self._settingOffsets[row]
+    setting = [0]*len(mask)
+    # mixed-radix decoding, the last factor being the fastest varying one
+    for mfi in range(len(mask)-1, -1, -1):
+      index, modality = divmod(index, len(mask[mfi]))
+      setting[mfi] = mask[mfi][modality]
+    return setting
+
+  def __encodeSetting__(self, setting):
+    # returns the position in the setting set of a setting given its modality indexes, or None if not reachable
+    self.__setSettings__()
+    position = None
+    if self._maskRows is None:
+      position = 0
+      for mfi, modality in enumerate(setting):
+        position = position*self.__nbModalities__(self.factors()[mfi])+modality
+    else:
+      if self._maskRowIndexes is None:
+        self._maskRowIndexes = [[{m: p for p, m in enumerate(mf)} for mf in row] for row in self._maskRows]
+      for row, offset in zip(self._maskRowIndexes, self._settingOffsets):
+        flat = 0
+        for mf, modality in zip(row, setting):
+          if modality not in mf:
+            break
+          flat = flat*len(mf)+mf[modality]
+        else:
+          position = offset+flat
+          break
+    if position is None or self._selection is None:
+      return position
+    if not self._selection[position]:
+      return None
+    chunk = position//_selectionChunkSize
+    return self._selectionCounts[chunk]+int(np.count_nonzero(self._selection[chunk*_selectionChunkSize:position]))
+
+  def __checkConstraints__(self, settings):
+    # evaluates the constraints on the modality values of an index matrix
+    values = types.SimpleNamespace()
+    for fi, f in enumerate(self.factors()):
+      setattr(values, f, self.__modalityArray__(f)[settings[:, fi]])
+    valid = np.ones(len(settings), dtype=bool)
+    for constraint in self._constraints:
+      valid &= np.asarray(constraint(values), dtype=bool)
+    return valid
+
+  def __modalityArray__(self, factor):
+    # the modalities of a factor as a numpy array, of object type if the modalities are of different types or are sequences
+    modalities = object.__getattribute__(self, factor)
+    if isinstance(modalities, np.ndarray):
+      return modalities
+    if not isinstance(modalities, list):
+      modalities = [modalities]
+    types = set(type(m) for m in modalities)
+    if len(types) == 1 and not issubclass(types.pop(), (list, tuple, dict, np.ndarray)):
+      return np.array(modalities)
+    array = np.empty(len(modalities), dtype=object)
+    for mi, m in enumerate(modalities):
+      array[mi] = m
+    return array
+
+  def __unravel__(self, flat):
+    # returns the index matrix of the settings given their positions in the complete setting set
+    grid = [self.__nbModalities__(f) for f in self.factors()]
+    settings = np.empty((len(flat), len(grid)), dtype=self.__dtype__())
+    for mfi in range(len(grid)-1, -1, -1):
+      settings[:, mfi] = flat % grid[mfi]
+      flat = flat // grid[mfi]
     return settings
 
+  def __dtype__(self):
+    # smallest integer type able to store the modality indexes of every factor
+    modalityCounts = [self.__nbModalities__(f) for f in self.factors()]
+    return next(t for t in (np.int8, np.int16, np.int32, np.int64) if max(modalityCounts) <= np.iinfo(t).max)
+
+  def __disjointMaskRows__(self, rows):
+    # split the mask rows such that no setting is reachable by several rows, the settings reachable by a row being removed from the following ones
+    disjointRows = []
+    for ri, row in enumerate(rows):
+      disjointRows += self.__remainingPieces__(row, [[set(mf) for mf in previous] for previous in rows[:ri]])
+    return disjointRows
+
+  def __remainingPieces__(self, row, previous):
+    # splits a mask row into pieces holding the settings not reachable by the previous rows, such that iterating over the pieces in turn follows the order of iteration of the row
+    if not previous:
+      return [row]
+    if not row:
+      return []
+    # consecutive modalities of the first factor reachable by the same previous rows
+    runs = []
+    for m in row[0]:
+      covering = [p for p in previous if m in p[0]]
+      if runs and len(runs[-1][1]) == len(covering) and all(p is q for p, q in zip(runs[-1][1], covering)):
+        runs[-1][0].append(m)
+      else:
+        runs.append(([m], covering))
+    pieces = []
+    for modalities, covering in runs:
+      subPieces = self.__remainingPieces__(row[1:], [p[1:] for p in covering])
+      if len(subPieces) > 1:
+        # each modality goes through all the sub pieces before the next one
+        pieces += [[[m]]+subPiece for m in modalities for subPiece in subPieces]
+      else:
+        pieces += [[modalities]+subPiece for subPiece in subPieces]
+    return pieces
+
+  def __nbModalities__(self, factor):
+    modalities = object.__getattribute__(self, factor)
+    if isinstance(modalities, list) or isinstance(modalities, np.ndarray):
+      return len(modalities)
+    return 1
+
+  def __maskRows__(self, mask=None):
+    # normalize the mask as a list of rows, each row storing an array of distinct modality indexes per factor
+    nbFactors = len(self.factors())
+    if mask is None or len(mask)==0:
+      mask = [[-1]*nbFactors]
+    if isinstance(mask, list) and not all(isinstance(x, list) for x in mask):
+      mask = [mask]
+
+    rows = []
+    for m in mask:
+      m = list(m[:nbFactors])+[-1]*(nbFactors-len(m))
+      row = []
+      for mfi, mf in enumerate(m):
+        if isinstance(mf, list):
+          row.append(np.array(list(dict.fromkeys(mf)), dtype=np.int64))
+        elif mf == -1:
+          row.append(np.arange(self.__nbModalities__(self.factors()[mfi])))
+        else:
+          row.append(np.array([mf], dtype=np.int64))
+      rows.append(row)
+    return rows
+
+  def __setSettingsMask__(self, mask, dtype=np.int64):
+    # cartesian product of the modality indexes of a mask row, broadcasted in place into a (nbSettings, nbFactors) index matrix
+    nbFactors = len(mask)
+    settings = np.empty([len(m) for m in mask]+[nbFactors], dtype=dtype)
+    for mfi, mf in enumerate(mask):
+      shape = [1]*nbFactors
+      shape[mfi] = -1
+      settings[..., mfi] = mf.reshape(shape)
+    return settings.reshape(-1, nbFactors)
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod(optionflags=doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE)
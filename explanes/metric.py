@@ -26,7 +26,7 @@ class Metric():
   >>> m = el.metric.Metric()
   >>> m.duration = ['mean', 'std']
   >>> m._unit.duration = 'second'
-  >>> m._description = 'duration of the processing'
+  >>> m._description.duration = 'duration of the processing'
 
   It is sometimes useful to store complementary data useful for plotting that must not be considered during the reduction.
 
@@ -37,6 +37,12 @@ class Metric():
   >>> m.metric2 = ['median-2', 'min-2', 'max-2', '0%']
 
   In this case, the odd values will be removed before reduction and the last reduction will select the first value of the metric vector, expressed in percents by multiplying it by 100.
+
+  The resources used by each setting, stored when running :meth:`explanes.experiment.Experiment.do` with resources=True, are reduced as any other metric, and come with their unit and description, see :data:`explanes.util.resourceMetrics`.
+
+  >>> m.peakMemory = ['max']
+  >>> m._unit.peakMemory
+  'bytes'
   """
   def __init__(self):
     self._unit = types.SimpleNamespace()
@@ -50,6 +56,12 @@ class Metric():
     ):
     if not hasattr(self, name) and name[0] != '_':
       self._metrics.append(name)
+      # resource metrics stored by explanes.experiment.Experiment.do come with their unit and description
+      if name in eu.resourceMetrics:
+        if not hasattr(self._unit, name):
+          setattr(self._unit, name, eu.resourceMetrics[name][0])
+        if not hasattr(self._description, name):
+          setattr(self._description, name, eu.resourceMetrics[name][1])
     return object.__setattr__(self, name, value)
 
   def reduceFromNpy(
@@ -101,7 +113,7 @@ class Metric():
             idx+=1
       if len(row) and not all(np.isnan(c) for c in row):
         for factorName in reversed(settings.factors()):
-          row.insert(0, setting.__getattribute__(factorName))
+          row.insert(0, getattr(setting, factorName))
         table.append(row)
     nbFactors = len(settings.factors())
     for ir, row in enumerate(table):
@@ -147,7 +159,7 @@ class Metric():
             row.append(self.reduceMetric(data, reductionType, reductionDirectiveModule))
         if len(row) and not all(np.isnan(c) for c in row):
           for factorName in reversed(settings.factors()):
-            row.insert(0, setting.__getattribute__(factorName))
+            row.insert(0, getattr(setting, factorName))
         table.append(row)
     h5.close()
     return (table, metricHasData)
@@ -0,0 +1,182 @@
+import os
+import pickle
+import hashlib
+import threading
+import collections
+
+# number of locks shared by the cache keys, so that the locks do not grow with the number of keys
+_nbLocks = 64
+
+def _parametersKey(parameters):
+  # hash of the parameters given to the stages, pickled, or described by repr if they can not be pickled
+  try:
+    description = pickle.dumps(parameters)
+  except Exception:
+    description = repr(parameters).encode('utf-8')
+  return hashlib.md5(description).hexdigest()
+
+class Pipeline():
+  """runs a step as a sequence of stages, reusing the output of a stage across the settings that share the modalities this output depends on.
+
+  A Pipeline object is a function that can be given to :meth:`explanes.experiment.Experiment.do`. Each stage is a function that operates on a setting and the output of the previous stage, and declares the factors it depends on. The output of a stage is cached under the hashed id of the setting projected on the factors of this stage and of the previous stages, and under the hash of the parameters given to the stages, so that it is computed once for all the settings that share these modalities, and that the file names of the cache stay short whatever the number of factors.
+
+  The cache is kept in memory, or on disk if a path is given, in which case it is also shared by the processes of the process backend and reused by subsequent runs. The outputs kept in memory are released with the Pipeline object only, unless their number is bounded by cacheSize.
+
+  Parameters
+  ----------
+
+  path: str (optional)
+    path to a directory where the outputs of the stages are stored.
+
+    If empty, the outputs are kept in memory (default).
+
+  cacheSize: int (optional)
+    maximum number of outputs kept in memory, the least recently used output being discarded first.
+
+    If 0, every output is kept (default).
+
+  See Also
+  --------
+
+  explanes.pipeline.Pipeline.stage, explanes.experiment.Experiment.do
+
+  Examples
+  --------
+
+  >>> import explanes as el
+
+  >>> e = el.experiment.Experiment()
+  >>> e.factor.dataType = ['sin', 'cos']
+  >>> e.factor.threshold = [1, 2, 3]
+
+  >>> def features(setting, experiment):
+  ...   print('features of '+setting.dataType)
+  ...   return len(setting.dataType)
+  >>> def evaluate(setting, experiment, features):
+  ...   print(setting.id(), features > setting.threshold)
+
+  >>> pipeline = el.Pipeline()
+  >>> pipeline.stage(features, ['dataType'])
+  >>> pipeline.stage(evaluate)
+  >>> nbFailed = e.do([], pipeline, progress=False)
+  features of sin
+  dataType_sin_threshold_1 True
+  dataType_sin_threshold_2 True
+  dataType_sin_threshold_3 False
+  features of cos
+  dataType_cos_threshold_1 True
+  dataType_cos_threshold_2 True
+  dataType_cos_threshold_3 False
+
+  The outputs are cached separately for different parameters given to the stages:
+
+  >>> def scaledFeatures(setting, experiment, scale):
+  ...   print('features of '+setting.dataType+' scaled by '+str(scale))
+  ...   return len(setting.dataType)*scale
+  >>> def scaledEvaluate(setting, experiment, features, scale):
+  ...   print(setting.id(), features > setting.threshold)
+
+  >>> pipeline = el.Pipeline()
+  >>> pipeline.stage(scaledFeatures, ['dataType'])
+  >>> pipeline.stage(scaledEvaluate)
+  >>> nbFailed = e.do([0, [0, 1]], pipeline, 1, progress=False)
+  features of sin scaled by 1
+  dataType_sin_threshold_1 True
+  dataType_sin_threshold_2 True
+  >>> nbFailed = e.do([0, [0, 1]], pipeline, 0.5, progress=False)
+  features of sin scaled by 0.5
+  dataType_sin_threshold_1 True
+  dataType_sin_threshold_2 False
+  """
+
+  def __init__(self, path='', cacheSize=0):
+    self.path = os.path.expanduser(path)
+    self.cacheSize = cacheSize
+    self._stages = []
+    self._cache = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._locks = [threading.Lock() for l in range(_nbLocks)]
+
+  def stage(
+    self,
+    function,
+    factors=None
+    ):
+    """append a stage to the pipeline.
+
+    Parameters
+    ----------
+
+    function: function(:class:`~explanes.setting.Setting`, :class:`~explanes.experiment.Experiment`, \*parameters) for the first stage, function(:class:`~explanes.setting.Setting`, :class:`~explanes.experiment.Experiment`, output, \*parameters) for the following ones
+      operates on a setting, and returns the output given to the next stage.
+
+    factors: list of str or None (optional)
+      names of the factors the stage depends on, in addition to the factors of the previous stages.
+
+      If None, the stage depends on every factor and its output is not cached (default).
+    """
+    self._stages.append((function, factors))
+
+  def __call__(
+    self,
+    setting,
+    experiment,
+    *parameters
+    ):
+    output = None
+    # factors the output of the current stage depends on, None meaning every factor
+    dependencies = set()
+    parametersKey = _parametersKey(parameters) if parameters else ''
+    for index, (function, factors) in enumerate(self._stages):
+      inputs = (output,) if index else ()
+      if factors is None or dependencies is None:
+        dependencies = None
+        output = function(setting, experiment, *inputs, *parameters)
+        continue
+      dependencies.update(factors)
+      # id of the setting projected on the factors the output depends on
+      key = 'stage'+str(index)+'_'+function.__name__+'_'+setting.id('hash', hide=[f for f in setting._factor.factors() if f not in dependencies])
+      if parametersKey:
+        key += '_'+parametersKey
+      # the output is computed once even if settings sharing the key are run concurrently
+      with self._locks[hash(key) % _nbLocks]:
+        found, output = self.__load__(key)
+        if not found:
+          output = function(setting, experiment, *inputs, *parameters)
+          self.__store__(key, output)
+    return output
+
+  def __load__(self, key):
+    with self._lock:
+      if key in self._cache:
+        self._cache.move_to_end(key)
+        return True, self._cache[key]
+    if self.path and os.path.exists(os.path.join(self.path, key+'.pkl')):
+      with open(os.path.join(self.path, key+'.pkl'), 'rb') as file:
+        return True, pickle.load(file)
+    return False, None
+
+  def __store__(self, key, output):
+    if self.path:
+      fileName = os.path.join(self.path, key+'.pkl')
+      with open(fileName+str(os.getpid()), 'wb') as file:
+        pickle.dump(output, file)
+      os.replace(fileName+str(os.getpid()), fileName)
+    else:
+      with self._lock:
+        self._cache[key] = output
+        if self.cacheSize and len(self._cache) > self.cacheSize:
+          self._cache.popitem(last=False)
+
+  def __getstate__(self):
+    # the locks and the outputs kept in memory are not sent to the processes of the process backend
+    state = self.__dict__.copy()
+    state['_cache'] = collections.OrderedDict()
+    del state['_lock']
+    del state['_locks']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+    self._locks = [threading.Lock() for l in range(_nbLocks)]
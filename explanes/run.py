@@ -10,6 +10,7 @@ import copy
 import subprocess
 import numpy as np
 import shutil
+import shlex
 
 def run():
   """This method shall be called from the main script of the experiment to control the experiment using the command line.
@@ -103,6 +104,19 @@ optional arguments:
   parser.add_argument('-d', '--display', type=str, help='display metrics. If no parameter is given, consider the default display and show all metrics. If the str parameter contain a list of integers, use the default display and show only the selected metrics defined by the integer list. If the str parameter contain a name, run the display method with this name.', nargs='?', default='-1')
   parser.add_argument('-E', '--export', type=str, help='Export the display of reduced metrics among different file types (html, png, pdf). If parameter is empty, all exports are made. If parameter has a dot, interpreted as a filename which should be of support type. If parameter has nothing before the dot, interpreted as file type, and experiment.project.name is used. If parameter has no dot, interpreted as file name with no extension, and all exports are made', nargs='?', default='none')
   parser.add_argument('-r', '--run', type=int, help='perform computation. Integer parameter sets the number of jobs computed in parallel (default to one core).', nargs='?', const=1)
+  parser.add_argument('-B', '--backend', type=str, help='parallel backend used when running with more than one job: sharedmem (default) runs the settings in threads sharing the experiment, process runs the settings in a pool of processes, which is suited for CPU bound steps', choices=['sharedmem', 'process'], default='sharedmem')
+  parser.add_argument('--skip-done', '--skipDone', dest='skipDone', help='do not run the settings whose metrics are all available in the output path', action='store_true')
+  parser.add_argument('--resume', type=str, help='resume the run with the given run identifier: the settings that ended or failed according to the journal of this run are not run again')
+  parser.add_argument('--shard', type=str, help='run only the shard i out of N of the settings, given as i/N, and store the data in a partition of the output path specific to the shard')
+  parser.add_argument('--shards', type=int, help='run the settings as N shards, on the hosts of experiment.host in turn if any, as local processes otherwise, in which case the run exits with a non-zero status if a shard fails')
+  parser.add_argument('--balance', type=str, help='balance the shards using the durations saved in the given json file instead of assigning the settings to the shards in turn. With --shards and no file, the durations journaled by the previous runs in the output path are first saved in a file of the output path, given to every shard', nargs='?', const='')
+  parser.add_argument('--claim', type=str, help='claim each setting in the output path before running it, so that concurrent runs sharing the output path and the given run identifier, the identifier of the run by default, run each setting once', nargs='?', const='')
+  parser.add_argument('--resources', help='store the wall clock time, processor time, peak memory and bytes read and written by each setting as metrics', action='store_true')
+  parser.add_argument('--timeout', type=float, help='fail the settings lasting more than the given number of seconds. With the process backend, hung settings are killed', default=0)
+  parser.add_argument('--retries', type=int, help='run again a failed setting up to the given number of times, with an increasing delay', default=0)
+  parser.add_argument('--max-failure-rate', '--maxFailureRate', dest='maxFailureRate', type=float, help='abort the run once the ratio of failed settings among the completed ones exceeds the given rate', default=1)
+  parser.add_argument('--memory-budget', '--memoryBudget', dest='memoryBudget', type=float, help='start a setting only when the peak memory of the running settings, predicted from the peak memory measured by the previous runs with --resources, fits the given number of gigabytes, and run less jobs while the processors are loaded by other processes', default=0)
+  parser.add_argument('--profile', type=str, help='run each setting under cProfile, and report the hot spots of the profiles merged across settings, stored in the profile.prof file of the profile directory of the output path. If a factor is given, also report and store the profiles merged per modality of this factor', nargs='?', const='')
   parser.add_argument('-D', '--debug', help='debug mode', action='store_true')
   parser.add_argument('-v', '--version', help='print version', action='store_true')
   parser.add_argument('-P', '--progress', help='display progress bar', action='store_true')
@@ -140,6 +154,14 @@ optional arguments:
   experiment = config.set(experiment)
   experiment.mask = mask
   experiment.status.debug = args.debug
+  shard = None
+  if args.shard:
+    shard = tuple(int(i) for i in args.shard.split('/'))
+    if args.balance == '':
+      print('The file of durations shared by the shards should be given to --balance when running a single shard.')
+      raise ValueError
+  if args.resume:
+    experiment.status.runId = args.resume
 
   if args.experiment != 'all':
     if hasattr(experiment.factor, args.experiment):
@@ -176,6 +198,34 @@ optional arguments:
       experiment.cleanDataSink(path2clean, experiment.mask, reverse=True, settingEncoding=experiment._settingEncoding)
 
   logFileName = ''
+  if args.shards:
+    if args.balance == '':
+      # every shard reads the same durations, so that the shards partition the setting set
+      args.balance = os.path.join(os.path.dirname(el.util.manifestPath(experiment.path.output)), '.durations_'+experiment.status.runId+'.json')
+      el.util.writeDurations(experiment.path.output, args.balance)
+    unparser = argunparse.ArgumentUnparser()
+    processes = []
+    for index in range(args.shards):
+      kwargs = copy.deepcopy(vars(args))
+      kwargs['shards'] = None
+      kwargs['shard'] = str(index)+'/'+str(args.shards)
+      if experiment.host:
+        kwargs['server'] = -3
+        command = unparser.unparse(**kwargs).replace('\'', '\"').replace('\"', '\\\"')
+        command = 'screen -dm bash -c \'python3 '+experiment.project.name+'.py '+command+'\''
+        host = experiment.host[index % len(experiment.host)]
+        command = 'ssh '+host+' "cd '+experiment.path.code_raw+'; '+command+'"'
+        print(command)
+        os.system(command)
+        print('shard '+kwargs['shard']+' launched on host: '+host)
+      else:
+        processes.append(subprocess.Popen([sys.executable, sys.argv[0]]+shlex.split(unparser.unparse(**kwargs))))
+    failed = False
+    for index, process in enumerate(processes):
+      if process.wait():
+        print('shard '+str(index)+'/'+str(args.shards)+' failed with exit status '+str(process.returncode))
+        failed = True
+    exit(1 if failed else 0)
   if args.server>-2:
     unparser = argunparse.ArgumentUnparser()
     kwargs = copy.deepcopy(vars(args))
@@ -202,7 +252,12 @@ optional arguments:
   if args.mail>-1:
     experiment.sendMail(args.mask+' has started.', '<div> Mask = '+args.mask+'</div>')
   if args.run and hasattr(config, 'step'):
-    experiment.do(mask, config.step, nbJobs=args.run, logFileName=logFileName, progress=args.progress, mailInterval = float(args.mail))
+    experiment.do(mask, config.step, nbJobs=args.run, logFileName=logFileName, progress=args.progress, mailInterval = float(args.mail), backend=args.backend, skipDone=args.skipDone, resume=args.resume is not None, shard=shard, balance=args.balance or '', claim=args.claim or args.claim is not None, resources=args.resources, timeout=args.timeout, retries=args.retries, maxFailureRate=args.maxFailureRate, memoryBudget=args.memoryBudget*2**30, profile=args.profile is not None)
+    if args.profile is not None:
+      output = experiment.path.output
+      if shard:
+        output = el.util.shardPath(output, *shard)
+      profileDisplay(experiment, args, mask, output)
 
 
   selectDisplay = []
@@ -335,6 +390,29 @@ def dataFrameDisplay(experiment, args, config, selectDisplay, selectFactor):
 
   return (df, header, styler)
 
+def profileDisplay(experiment, args, mask, output):
+  path = el.util.profilePath(output)
+  profiles = el.util.mergeProfiles(path, experiment.factor.mask(mask), args.profile, experiment._settingEncoding)
+  if not profiles:
+    print('No profile found in '+path)
+    return
+  for modality, stats in profiles.items():
+    stats.dump_stats(os.path.join(path, 'profile.prof' if modality is None else 'profile_'+args.profile+'_'+str(modality)+'.prof'))
+  print('Profile merged across settings stored in '+os.path.join(path, 'profile.prof'))
+  # the header would otherwise list the profile file of every setting
+  profiles[None].files = []
+  profiles[None].sort_stats('tottime').print_stats(20)
+  if args.profile:
+    # share of the time of each modality spent in the functions with the largest time overall
+    functions = sorted(profiles[None].stats, key=lambda f: -profiles[None].stats[f][2])[:20]
+    table = {}
+    for modality, stats in profiles.items():
+      if modality is not None:
+        table[args.profile+' '+str(modality)] = [100*stats.stats[f][2]/stats.total_tt if f in stats.stats and stats.total_tt else 0 for f in functions]
+    df = pd.DataFrame(table, index=[f[2] if f[0] == '~' else os.path.basename(f[0])+':'+str(f[1])+'('+f[2]+')' for f in functions])
+    print('Percentage of the time spent in each function per modality of '+args.profile)
+    print(df.round(1).to_string())
+
 def highlightMax(s):
   is_max = s == s.max()
   return ['font-weight: bold' if v else '' for v in is_max]
@@ -1,14 +1,74 @@
 import explanes.util as eu
+import numpy as np
 import hashlib
-import copy
 import logging
 import traceback
+import time
+import os
+import signal
+import select
+import threading
+import asyncio
+import cProfile
+import json
+
+# delay in seconds before the first retry of a failed setting, doubled at each retry
+_retryDelay = 1
+
+def _profiled(function, fileName):
+  # returns the function run under cProfile, its profile being stored in fileName, also when run in a forked child process
+  def run(*arguments):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+      return function(*arguments)
+    finally:
+      profiler.disable()
+      profiler.dump_stats(fileName)
+  return run
+
+def index(setting):
+  """returns the position of a setting in the setting set of its :class:`~explanes.factor.Factor` object.
+
+  Returns the position of the setting in the setting set defined by the current mask of its :class:`~explanes.factor.Factor` object, such that factor.setting(explanes.setting.index(setting)) returns the same setting. This is a function of the module rather than a method of the setting, so that a factor can be named index.
+
+  See Also
+  --------
+
+  explanes.factor.Factor.setting
+
+  Examples
+  --------
+
+  >>> import explanes as el
+
+  >>> f = el.factor.Factor()
+  >>> f.one = ['a', 'b', 'c']
+  >>> f.two = [1, 2, 3]
+
+  >>> for setting in f.mask([[1, 2], [0, 2], -1]):
+  ...   print(el.setting.index(setting))
+  0
+  1
+  2
+  3
+  >>> print(el.setting.index(setting.replace('two', value=1)))
+  2
+  """
+  position = setting._factor.__encodeSetting__(setting._setting)
+  positions = setting._factor.__positions__()
+  if position is None or position not in positions:
+    print('The setting '+str(setting)+' is not reachable in the setting set.')
+    raise ValueError
+  return positions.index(position)
 
 class Setting():
   """stores a :term:`setting`, where each member is a factor and the value of the member is a modality.
 
   Stores a :term:`setting`, where each member is a factor and the value of the member is a modality.
 
+  A setting is a lightweight view over its :class:`~explanes.factor.Factor` object: it only stores a reference to the Factor object and the modality indexes of each factor. The value of the modality of a factor is resolved when accessed.
+
   Examples
   --------
 
@@ -27,21 +87,26 @@ class Setting():
 
   """
 
+  __slots__ = ('_factor', '_setting', '_ids')
+
   def __init__(self, factor, settingArray=None):
     self._factor = factor
-    # underscore = ['_nonSingleton', '_default', '_factors', '_setting']
-    # for f in underscore:
-    #   self.__setattr__(f, getattr(factor, f))
-
-    if settingArray:
-      self._setting = copy.deepcopy(settingArray)
+    self._ids = None
+    if settingArray is not None:
+      self._setting = tuple(settingArray)
     else:
-      self._setting = copy.deepcopy(factor._setting)
+      self._setting = tuple(factor._setting)
 
-    for fi, f in enumerate(factor.factors()):
-      # print(self._setting[fi])
-      # print(f)
-      self.__setattr__(f, getattr(factor, f)[self._setting[fi]])
+  def __getattr__(self, name):
+    if name[0] == '_' or name not in self._factor._factorPositions:
+      raise AttributeError(name)
+    modality = self._setting[self._factor._factorPositions[name]]
+    if modality is None:
+      return None
+    modalities = getattr(self._factor, name)
+    if isinstance(modalities, list) or isinstance(modalities, np.ndarray):
+      return modalities[modality]
+    return modalities
 
   def __str__(self):
     """returns a one-liner str with a readable description of the Factor object or the current setting.
@@ -76,6 +141,8 @@ class Setting():
 
   	Return a one-liner str or a list of str that describes a setting or a :class:`~explanes.factor.Factor` object with a high degree of flexibility.
 
+  	The compressed names of the factors and modalities are computed once per encoding and stored in the :class:`~explanes.factor.Factor` object, and the id of the setting is stored for each encoding, so that repeated calls are lookups.
+
   	Parameters
   	----------
 
@@ -191,27 +258,25 @@ class Setting():
     >>> print(setting.id(format = 'short'))
     oppa_vaon_th_c_tw_1
     """
-    id = []
-    fNames = self._factor._factors
-    if isinstance(hide, str):
-      hide=[hide]
-    elif isinstance(hide, int) :
-      hide=[fNames[hide]]
-    elif isinstance(hide, list) and len(hide) and isinstance(hide[0], int) :
-      for oi, o in enumerate(hide):
-        hide[oi]=fNames[o]
-    if sort:
-      fNames = sorted(fNames)
-    for fIndex, f in enumerate(fNames):
-      if f[0] != '_' and getattr(self, f) is not None and f not in hide:
-        if (singleton or f in self._factor._nonSingleton) and (default or not hasattr(self._factor._default, f) or (not default and hasattr(self._factor._default, f) and getattr(self._factor._default, f) != getattr(self, f))): 
-          id.append(eu.compressDescription(f, format))
-          id.append(eu.compressDescription(str(getattr(self, f)), format))
-    if 'list' not in format:
-      id = separator.join(id)
-      if format == 'hash':
-        id  = hashlib.md5(id.encode("utf-8")).hexdigest()
-    return id
+    if isinstance(hide, str) or isinstance(hide, int):
+      hide = (hide,)
+    key = (format, sort, separator, singleton, default, tuple(hide))
+    if self._ids is None:
+      self._ids = {}
+    if key not in self._ids:
+      id = []
+      for fi, factorToken, modalityTokens in self._factor.__idTokens__(format, sort, singleton, default, tuple(hide)):
+        if self._setting[fi] is not None and modalityTokens[self._setting[fi]] is not None:
+          id.append(factorToken)
+          id.append(modalityTokens[self._setting[fi]])
+      if 'list' not in format:
+        id = separator.join(id)
+        if format == 'hash':
+          id  = hashlib.md5(id.encode("utf-8")).hexdigest()
+      self._ids[key] = id
+    if 'list' in format:
+      return list(self._ids[key])
+    return self._ids[key]
 
   def replace(self, factor, value=None, positional=0, relative=0):
     """returns a new explanes.factor.Factor object with one factor with modified modality.
@@ -276,17 +341,14 @@ class Setting():
       modalities = self._factor.__getattribute__(factorName)
       positional = modalities.index(value)
 
-    sDesc = copy.deepcopy(self._setting)
     if relative:
-      sDesc[factor] += relative
-    else:
-      sDesc[factor] = positional
+      positional = self._setting[factor]+relative
 
-    if sDesc[factor]< 0 or sDesc[factor] >= self._factor.nbModalities(factor):
+    if positional < 0 or positional >= self._factor.nbModalities(factor):
       print('Unable to find the requested modality.')
       return None
     else:
-      s = Setting(self._factor, sDesc)
+      s = Setting(self._factor, self._setting[:factor]+(positional,)+self._setting[factor+1:])
       return s
 
   def do(
@@ -294,34 +356,224 @@ class Setting():
     function,
     experiment,
     logFileName,
-    *parameters
+    *parameters,
+    journal='',
+    claims='',
+    resources='',
+    timeout=0,
+    retries=0,
+    kill=False,
+    profile='',
+    manifest='',
+    described=(),
+    concurrent=False
     ):
     """run the function given as parameter for the setting.
 
   	Helper function for the method :meth:`~explanes.factor.Factor.do`.
 
+  	If journal is not empty, the start of the run of the setting and its outcome, end, failed or interrupted, are appended with the duration to the journal file, see :meth:`explanes.util.writeJournal`.
+
+  	If claims is not empty, the setting is run only if it can be claimed in the claims directory, see :meth:`explanes.util.claim`, and is released once run. The setting is marked as processed only if it ended, so that a failed or interrupted setting can be claimed again by a later run.
+
+  	If manifest is not empty, the description of the setting is appended to the manifest file before the setting is run, unless its id is in described, the ids of the settings already described in the manifest, see :meth:`explanes.util.readManifest`.
+
+  	If resources is not empty, the resources used by the function are measured, see :meth:`explanes.util.measureResources`, and stored as metrics of the setting in the resources data sink if the function succeeds, see :meth:`explanes.util.storeResources`. If concurrent is True, other settings are run concurrently in the same process, and the peak memory of the process is not reset. If the attempts are run in forked child processes, the resources are measured by the child process of the attempt that succeeded.
+
+  	If timeout > 0, an attempt lasting more than timeout seconds fails with a TimeoutError. If kill is True, each attempt is run in a forked child process, killed on timeout, which stops the attempt even if it is stuck outside of the Python interpreter. Otherwise, the attempt is interrupted by a SIGALRM signal, which requires to run in the main thread.
+
+  	If retries > 0, a failed attempt is retried up to retries times, after a delay doubled at each retry. Each retry is appended to the journal.
+
+  	If profile is not empty, each attempt is run under cProfile, and the profile of the last attempt is stored in the file <id_of_setting>.prof of the profile directory, see :meth:`explanes.util.mergeProfiles`.
+
+  	Returns 1 if the setting failed and logFileName is not empty, 0 if it ran otherwise, and None if it was not run as it is claimed by another run.
+
   	See Also
   	--------
 
     explanes.factor.Factor.do
 
     """
+    started = self.__start__(experiment, journal, claims, resources, manifest, described, concurrent, profile)
+    if started is None:
+      return None
+    id, startTime, start = started
+    if profile:
+      function = _profiled(function, os.path.join(profile, id+'.prof'))
     failed = 0
+    event = 'interrupted'
     try:
-      function(self, experiment, *parameters)
+      for attempt in range(retries+1):
+        try:
+          measured = self.__attempt__(function, experiment, parameters, timeout, kill, bool(resources))
+          break
+        except Exception as e:
+          if attempt == retries:
+            raise e
+          self.__retry__(journal, id, attempt)
+          time.sleep(_retryDelay*2**attempt)
+      event = 'end'
+      if resources:
+        eu.storeResources(resources, id, measured or eu.measureResources(start, concurrent))
     except Exception as e:
-      if logFileName:
-        failed = 1
-        #print('setting '+setting.id()+' failed')
-        logging.info(traceback.format_exc())
-      else:
-        raise e
+      event = 'failed'
+      failed = self.__failed__(e, logFileName)
+    finally:
+      self.__stop__(journal, claims, id, event, startTime)
     return failed
 
+  async def doAsync(
+    self,
+    function,
+    experiment,
+    logFileName,
+    *parameters,
+    journal='',
+    claims='',
+    resources='',
+    timeout=0,
+    retries=0,
+    manifest='',
+    described=(),
+    concurrent=False
+    ):
+    """run the coroutine function given as parameter for the setting.
+
+  	Asynchronous version of :meth:`~explanes.setting.Setting.do`, awaiting the function. An attempt lasting more than timeout seconds is cancelled.
+
+  	See Also
+  	--------
+
+    explanes.setting.Setting.do
+
+    """
+    started = self.__start__(experiment, journal, claims, resources, manifest, described, concurrent)
+    if started is None:
+      return None
+    id, startTime, start = started
+    failed = 0
+    event = 'interrupted'
+    try:
+      for attempt in range(retries+1):
+        try:
+          await asyncio.wait_for(function(self, experiment, *parameters), timeout if timeout else None)
+          break
+        except Exception as e:
+          if attempt == retries:
+            raise e
+          self.__retry__(journal, id, attempt)
+          await asyncio.sleep(_retryDelay*2**attempt)
+      event = 'end'
+      if resources:
+        eu.storeResources(resources, id, eu.measureResources(start, concurrent))
+    except Exception as e:
+      event = 'failed'
+      failed = self.__failed__(e, logFileName)
+    finally:
+      self.__stop__(journal, claims, id, event, startTime)
+    return failed
+
+  def __start__(self, experiment, journal, claims, resources, manifest, described, concurrent, profile=''):
+    # claims the setting, describes it in the manifest and journals its start, returns its id, the start time and the resources used so far, or None if the setting is claimed by another run
+    id = self.id(**experiment._settingEncoding) if journal or claims or resources or profile or manifest else ''
+    if claims and not eu.claim(claims, id):
+      return None
+    if manifest and id not in described:
+      eu.writeJournal(manifest, {'id': id, 'setting': self.__description__()})
+    startTime = time.time()
+    if journal:
+      eu.writeJournal(journal, {'id': id, 'event': 'start', 'time': startTime})
+    start = eu.measureResources(concurrent=concurrent) if resources else None
+    return id, startTime, start
+
+  def __failed__(self, exception, logFileName):
+    # logs the failure of the setting and returns 1 if logFileName is not empty, raises the exception otherwise
+    if not logFileName:
+      raise exception
+    logging.info(traceback.format_exc())
+    return 1
+
+  def __stop__(self, journal, claims, id, event, startTime):
+    # journals the outcome of the setting and releases its claim, the setting being marked as processed only if it ended
+    if journal:
+      endTime = time.time()
+      eu.writeJournal(journal, {'id': id, 'event': event, 'time': endTime, 'duration': endTime-startTime})
+    if claims:
+      eu.release(claims, id, done=event == 'end')
+
+  def __description__(self):
+    # maps each factor to the modality of the setting, as python values
+    description = {}
+    for f in self._factor.factors():
+      value = getattr(self, f)
+      description[f] = value.item() if isinstance(value, np.generic) else value
+    return description
+
+  def __retry__(self, journal, id, attempt):
+    logging.info('retry '+str(attempt+1)+' of setting '+str(self)+' after '+traceback.format_exc())
+    if journal:
+      eu.writeJournal(journal, {'id': id, 'event': 'retry', 'time': time.time(), 'attempt': attempt+1, 'error': traceback.format_exc().strip().splitlines()[-1]})
+
+  def __attempt__(self, function, experiment, parameters, timeout, kill, measure=False):
+    # runs the function once, failing with a TimeoutError after timeout seconds, returns the resources used if measured in a child process, None otherwise
+    if not timeout:
+      function(self, experiment, *parameters)
+    elif kill:
+      reader, writer = os.pipe()
+      pid = os.fork()
+      if not pid:
+        # child process, reports the resources it used or the traceback of the failure, and exits without running the exit handlers of the parent
+        os.close(reader)
+        code = 0
+        try:
+          start = eu.measureResources() if measure else None
+          function(self, experiment, *parameters)
+          if measure:
+            os.write(writer, json.dumps(eu.measureResources(start)).encode())
+        except BaseException:
+          os.write(writer, traceback.format_exc().encode())
+          code = 1
+        finally:
+          os._exit(code)
+      os.close(writer)
+      try:
+        output = b''
+        deadline = time.time()+timeout
+        while True:
+          ready, _, _ = select.select([reader], [], [], max(deadline-time.time(), 0))
+          if not ready:
+            os.kill(pid, signal.SIGKILL)
+            raise TimeoutError('setting '+str(self)+' killed after '+str(timeout)+' seconds')
+          data = os.read(reader, 2**16)
+          if not data:
+            break
+          output += data
+      finally:
+        os.close(reader)
+        _, status = os.waitpid(pid, 0)
+      if status:
+        raise RuntimeError('setting '+str(self)+' failed in a child process\n'+(output.decode().strip() or 'exit status '+str(status)))
+      if measure:
+        return json.loads(output)
+    elif threading.current_thread() is threading.main_thread() and hasattr(signal, 'setitimer'):
+      def interrupt(signum, frame):
+        raise TimeoutError('setting '+str(self)+' interrupted after '+str(timeout)+' seconds')
+      handler = signal.signal(signal.SIGALRM, interrupt)
+      signal.setitimer(signal.ITIMER_REAL, timeout)
+      try:
+        function(self, experiment, *parameters)
+      finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, handler)
+    else:
+      print('Unable to enforce the timeout of the setting outside of the main thread. Please use the process backend.')
+      raise ValueError
+
   def remove(self, factor):
-    delattr(self, factor)
-    print(': '+factor)
-    # print(self)
+    if isinstance(factor, str):
+      factor = self._factor._factors.index(factor)
+    self._setting = self._setting[:factor]+(None,)+self._setting[factor+1:]
+    self._ids = None
     return self
 
 
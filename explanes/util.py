@@ -1,6 +1,15 @@
 import sys
+import os
 import re
 import copy
+import json
+import glob
+import time
+import socket
+import hashlib
+import threading
+import numpy as np
+import tables as tb
 
 def constantColumn(
   table=None
@@ -228,6 +237,613 @@ def expandMask(mask, factor, settings):
       nm.append(m)
   return nm
 
+def manifestPath(path):
+  """return the path of the manifest of a data sink.
+
+  The manifest of a directory is stored in this directory as a hidden file, and the manifest of a .h5 file is stored next to this file. The manifest is a json lines file, where a record describing a setting is appended each time the setting is run, see :meth:`explanes.util.writeJournal`.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> el.util.manifestPath('/tmp/test.h5')
+  '/tmp/test.h5.manifest.jsonl'
+  """
+  path = os.path.expanduser(path)
+  if path.endswith('.h5'):
+    return path+'.manifest.jsonl'
+  return os.path.join(path, '.manifest.jsonl')
+
+def readManifest(path):
+  """return the manifest of a data sink as a dict mapping each setting id to the description of the setting.
+
+  The description of the setting is a dict mapping each factor to its modality. An empty dict is returned if the data sink has no manifest.
+
+	See Also
+	--------
+
+  explanes.factor.Factor.manifest, explanes.setting.Setting.do
+  """
+  return {record['id']: record['setting'] for record in readJournal(manifestPath(path)) if 'id' in record and 'setting' in record}
+
+def journalPath(path, runId):
+  """return the path of the journal of a run stored in a data sink.
+
+  The journal of a run is stored in a directory data sink as a hidden file, and next to a .h5 data sink.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> el.util.journalPath('/tmp/test', '123')
+  '/tmp/test/.journal_123.jsonl'
+  """
+  path = os.path.expanduser(path)
+  if path.endswith('.h5'):
+    return path+'.journal_'+runId+'.jsonl'
+  return os.path.join(path, '.journal_'+runId+'.jsonl')
+
+def writeJournal(fileName, record):
+  """append a record to a journal.
+
+  The record is written as a json line using a single write to a file opened in append mode, so that concurrent writers do not interleave their records. Values that are not json serializable are written as str.
+  """
+  fd = os.open(fileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    os.write(fd, (json.dumps(record, default=str)+'\n').encode())
+  finally:
+    os.close(fd)
+
+def readJournal(fileName):
+  """return the list of the records of a journal.
+
+  An empty list is returned if the journal does not exist. A record truncated by a crash is ignored.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> import os
+  >>> if os.path.exists('/tmp/journal.jsonl'):
+  ...   os.remove('/tmp/journal.jsonl')
+  >>> el.util.writeJournal('/tmp/journal.jsonl', {'id': 'one_a', 'event': 'start'})
+  >>> el.util.writeJournal('/tmp/journal.jsonl', {'id': 'one_a', 'event': 'end'})
+  >>> el.util.readJournal('/tmp/journal.jsonl')
+  [{'id': 'one_a', 'event': 'start'}, {'id': 'one_a', 'event': 'end'}]
+  """
+  if not os.path.exists(fileName):
+    return []
+  records = []
+  with open(fileName) as file:
+    for line in file:
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        pass
+  return records
+
+def readDurations(path):
+  """return the mean duration of each setting that ended according to the journals of the runs stored in a data sink.
+
+  Returns a dict mapping the id of each setting that ended in a previous run to its mean duration in seconds over all the journals of the data sink.
+
+  The journals of the shards stored in the partitions of the data sink are also read, see :meth:`explanes.util.shardPath`.
+
+  If path is a .json file, the durations saved in this file by :meth:`explanes.util.writeDurations` are returned.
+
+	See Also
+	--------
+
+  explanes.util.journalPath, explanes.util.writeDurations, explanes.factor.Factor.predictCost
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> import os
+  >>> os.makedirs(el.util.shardPath('/tmp/durations', 1, 2), exist_ok=True)
+  >>> el.util.writeJournal(el.util.journalPath('/tmp/durations', '0'), {'id': 'a_1', 'event': 'end', 'duration': 2.0})
+  >>> el.util.writeJournal(el.util.journalPath(el.util.shardPath('/tmp/durations', 1, 2), '0'), {'id': 'a_2', 'event': 'end', 'duration': 3.0})
+  >>> sorted(el.util.readDurations('/tmp/durations').items())
+  [('a_1', 2.0), ('a_2', 3.0)]
+  """
+  if path.endswith('.json'):
+    with open(path) as file:
+      return json.load(file)
+  durations = {}
+  for fileName in glob.glob(journalPath(path, '*'))+glob.glob(journalPath(shardPath(path, '*', '*'), '*')):
+    for record in readJournal(fileName):
+      if record['event'] == 'end':
+        durations.setdefault(record['id'], []).append(record['duration'])
+  return {id: sum(d)/len(d) for id, d in durations.items()}
+
+def writeDurations(path, fileName):
+  """save in a json file the mean duration of each setting that ended according to the journals of the runs stored in a data sink.
+
+  The durations are read once by :meth:`explanes.util.readDurations` and saved in the file fileName, which can be given to every shard of a run, so that the shards are balanced according to the same durations whatever the journals written meanwhile, see :meth:`explanes.experiment.Experiment.do`.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> el.util.writeJournal('/tmp/.journal_0.jsonl', {'id': 'a_1', 'event': 'end', 'duration': 2.0})
+  >>> el.util.writeDurations('/tmp', '/tmp/durations.json')
+  >>> el.util.readDurations('/tmp/durations.json')['a_1']
+  2.0
+  """
+  durations = readDurations(path)
+  with open(fileName+str(os.getpid()), 'w') as file:
+    json.dump(durations, file)
+  os.replace(fileName+str(os.getpid()), fileName)
+
+def shardPath(path, index, nbShards):
+  """return the path of the partition of a data sink where a shard of the setting set is stored.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> el.util.shardPath('/tmp/test.h5', 0, 2)
+  '/tmp/test_shard0of2.h5'
+  >>> el.util.shardPath('/tmp/test/', 1, 2)
+  '/tmp/test/shard1of2/'
+  """
+  if path.endswith('.h5'):
+    return path[:-3]+'_shard'+str(index)+'of'+str(nbShards)+'.h5'
+  shard = os.path.join(path, 'shard'+str(index)+'of'+str(nbShards))
+  if path.endswith('/'):
+    shard += '/'
+  return shard
+
+def claimPath(path, runId=''):
+  """return the path of the directory where the claims of the settings stored in a data sink are kept.
+
+  The claims are scoped by a run identifier, shared by the runs that cooperate: a setting released as done by one of these runs is not run again by the others, whereas runs with another identifier run it again.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> el.util.claimPath('/tmp/test.h5')
+  '/tmp/test.h5.claims'
+  >>> el.util.claimPath('/tmp/test')
+  '/tmp/test/.claims'
+  >>> el.util.claimPath('/tmp/test', '123')
+  '/tmp/test/.claims/123'
+  """
+  path = os.path.expanduser(path)
+  if path.endswith('.h5'):
+    path = path+'.claims'
+  else:
+    path = os.path.join(path, '.claims')
+  if runId:
+    path = os.path.join(path, runId)
+  return path
+
+def profilePath(path):
+  """return the path of the directory where the profiles of the settings stored in a data sink are kept.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> el.util.profilePath('/tmp/test.h5')
+  '/tmp/test.h5.profiles'
+  >>> el.util.profilePath('/tmp/test')
+  '/tmp/test/.profiles'
+  """
+  path = os.path.expanduser(path)
+  if path.endswith('.h5'):
+    return path+'.profiles'
+  return os.path.join(path, '.profiles')
+
+def mergeProfiles(path, settings, groupBy='', settingEncoding={}):
+  """merge the profiles of settings.
+
+  The profile of each setting, stored by :meth:`explanes.setting.Setting.do` in the file <id_of_setting>.prof of the directory path, is merged with the profiles of the other settings, and with the profiles of the settings sharing the same modality of the factor groupBy, if any. The settings without profile are ignored.
+
+	Parameters
+	----------
+
+  path: str
+    the profile directory, see :meth:`explanes.util.profilePath`.
+
+  settings: :class:`explanes.factor.Factor`
+    the settings whose profiles are merged.
+
+  groupBy: str (optional)
+    name of a factor. If not empty, the profiles are also merged per modality of this factor.
+
+  settingEncoding : dict (optional)
+    format of the id describing the :term:`setting`. Please refer to :meth:`explanes.setting.Setting.id` for further information.
+
+	Returns
+	-------
+
+  profiles: dict
+    maps None to the :class:`pstats.Stats` merging all the profiles, and each modality of the factor groupBy to the :class:`pstats.Stats` merging the profiles of the settings with this modality, so that an empty modality is kept apart from the overall profile. A modality without profile is not reported, nor are the settings where groupBy has no modality. Empty if no setting has a profile.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> import numpy as np
+  >>> import shutil
+  >>> import os
+
+  >>> shutil.rmtree('/tmp/testProfiles', ignore_errors=True)
+  >>> os.makedirs('/tmp/testProfiles')
+  >>> e = el.experiment.Experiment()
+  >>> e.path.output = '/tmp/testProfiles'
+  >>> e.factor.size = [10, 100]
+  >>> e.factor.seed = [0, 1]
+  >>> def step(setting, experiment):
+  ...   sum(range(setting.size))
+  >>> nbFailed = e.do([], step, progress=False, profile=True)
+  >>> profiles = el.util.mergeProfiles(el.util.profilePath(e.path.output), e.factor, 'size')
+  >>> sorted(profiles, key=str)
+  [10, 100, None]
+  >>> # number of calls of the step function, overall and for the settings of size 10
+  >>> [[calls[0] for function, calls in profiles[modality].stats.items() if function[2] == 'step'] for modality in [None, 10]]
+  [[4], [2]]
+  """
+  import pstats
+  profiles = {}
+  for setting in settings:
+    fileName = os.path.join(path, setting.id(**settingEncoding)+'.prof')
+    if not os.path.exists(fileName):
+      continue
+    modality = getattr(setting, groupBy) if groupBy else None
+    for key in [None] + ([modality] if modality is not None else []):
+      if key in profiles:
+        profiles[key].add(fileName)
+      else:
+        profiles[key] = pstats.Stats(fileName)
+  return profiles
+
+# claim files held by this process, whose modification time is refreshed by the heartbeat thread
+_claims = set()
+_claimsLock = threading.Lock()
+_heartbeat = None
+
+def _resetClaims():
+  # a forked process holds no claim and has no heartbeat thread
+  global _claims, _claimsLock, _heartbeat
+  _claims = set()
+  _claimsLock = threading.Lock()
+  _heartbeat = None
+
+os.register_at_fork(after_in_child=_resetClaims)
+
+def _heartbeatLoop(interval):
+  while True:
+    time.sleep(interval)
+    with _claimsLock:
+      for fileName in _claims:
+        try:
+          os.utime(fileName)
+        except OSError:
+          pass
+
+def claim(path, id, expiry=600):
+  """claim a setting, so that no other process runs it.
+
+  The claim is a file of the claim directory created atomically. The claim is a lease: while it is held, its modification time is refreshed by a heartbeat thread, and a claim that has not been refreshed for expiry seconds, for example because its process was killed, is taken over. A setting that has been released as done can not be claimed.
+
+	Parameters
+	----------
+
+  path: str
+    the claim directory, see :meth:`explanes.util.claimPath`.
+
+  id: str
+    the id of the setting.
+
+  expiry: float (optional)
+    duration in seconds after which a claim that has not been refreshed expires (default 600).
+
+	Returns
+	-------
+
+  claimed: bool
+    True if the setting is claimed by this process.
+
+	See Also
+	--------
+
+  explanes.util.release
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> import shutil
+  >>> import os
+  >>> shutil.rmtree('/tmp/testClaims', ignore_errors=True)
+  >>> os.makedirs('/tmp/testClaims')
+  >>> el.util.claim('/tmp/testClaims', 'one_a')
+  True
+  >>> el.util.claim('/tmp/testClaims', 'one_a')
+  False
+  >>> el.util.release('/tmp/testClaims', 'one_a')
+  >>> el.util.claim('/tmp/testClaims', 'one_a')
+  False
+  """
+  global _heartbeat
+  fileName = os.path.join(path, hashlib.md5(id.encode()).hexdigest())
+  if os.path.exists(fileName+'.done'):
+    return False
+  try:
+    fd = os.open(fileName, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+  except FileExistsError:
+    try:
+      if time.time()-os.path.getmtime(fileName) < expiry:
+        return False
+      # the expired claim is taken over by renaming it, which only one process succeeds in
+      expired = fileName+'.'+socket.gethostname()+'.'+str(os.getpid())
+      os.rename(fileName, expired)
+      if time.time()-os.path.getmtime(expired) < expiry:
+        # the claim has been renewed in the meantime, so it is restored
+        try:
+          os.link(expired, fileName)
+        except FileExistsError:
+          pass
+        os.remove(expired)
+        return False
+      os.remove(expired)
+    except FileNotFoundError:
+      return False
+    return claim(path, id, expiry)
+  os.write(fd, (socket.gethostname()+' '+str(os.getpid())+' '+id).encode())
+  os.close(fd)
+  with _claimsLock:
+    _claims.add(fileName)
+  if _heartbeat is None:
+    _heartbeat = threading.Thread(target=_heartbeatLoop, args=(expiry/4,), daemon=True)
+    _heartbeat.start()
+  return True
+
+def release(path, id, done=True):
+  """release the claim of a setting.
+
+	Parameters
+	----------
+
+  path: str
+    the claim directory, see :meth:`explanes.util.claimPath`.
+
+  id: str
+    the id of the setting.
+
+  done: bool (optional)
+    If True, the setting is marked as processed and can not be claimed anymore (default).
+
+    If False, the setting can be claimed again.
+
+	See Also
+	--------
+
+  explanes.util.claim
+  """
+  fileName = os.path.join(path, hashlib.md5(id.encode()).hexdigest())
+  if done:
+    os.close(os.open(fileName+'.done', os.O_WRONLY | os.O_CREAT, 0o644))
+  with _claimsLock:
+    _claims.discard(fileName)
+  try:
+    os.remove(fileName)
+  except FileNotFoundError:
+    pass
+
+def released(path, ids):
+  """return which settings have been released as done in a claim directory.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> import shutil
+  >>> import os
+  >>> shutil.rmtree('/tmp/testClaims', ignore_errors=True)
+  >>> os.makedirs('/tmp/testClaims')
+  >>> el.util.claim('/tmp/testClaims', 'one_a')
+  True
+  >>> el.util.release('/tmp/testClaims', 'one_a')
+  >>> el.util.released('/tmp/testClaims', ['one_a', 'one_b'])
+  [True, False]
+  """
+  names = set(os.listdir(path)) if os.path.isdir(path) else set()
+  return [hashlib.md5(id.encode()).hexdigest()+'.done' in names for id in ids]
+
+def forget(path, ids):
+  """remove the marks of the settings released as done in every claim directory of a data sink, so that they can be claimed again.
+
+  This function is called when the data of settings is removed from a data sink, see :meth:`explanes.factor.Factor.cleanDataSink`.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> import shutil
+  >>> import os
+  >>> shutil.rmtree(el.util.claimPath('/tmp/testSink'), ignore_errors=True)
+  >>> os.makedirs(el.util.claimPath('/tmp/testSink', '123'))
+  >>> el.util.claim(el.util.claimPath('/tmp/testSink', '123'), 'one_a')
+  True
+  >>> el.util.release(el.util.claimPath('/tmp/testSink', '123'), 'one_a')
+  >>> el.util.forget('/tmp/testSink', ['one_a'])
+  >>> el.util.claim(el.util.claimPath('/tmp/testSink', '123'), 'one_a')
+  True
+  >>> el.util.release(el.util.claimPath('/tmp/testSink', '123'), 'one_a', done=False)
+  """
+  for directory in glob.glob(os.path.join(claimPath(path), '*')):
+    for id in ids:
+      try:
+        os.remove(os.path.join(directory, hashlib.md5(id.encode()).hexdigest()+'.done'))
+      except FileNotFoundError:
+        pass
+
+resourceMetrics = {
+  'wallTime': ('seconds', 'wall clock time of the step'),
+  'cpuTime': ('seconds', 'processor time of the step'),
+  'peakMemory': ('bytes', 'peak resident memory during the step'),
+  'readBytes': ('bytes', 'bytes read during the step'),
+  'writtenBytes': ('bytes', 'bytes written during the step')
+  }
+"""units and descriptions of the resource metrics measured for each setting, see :meth:`explanes.util.measureResources`."""
+
+_resourcesLock = threading.Lock()
+
+def _readProc(fileName):
+  # returns the fields of a /proc file of the current process as a dict, empty if not available
+  fields = {}
+  try:
+    with open('/proc/self/'+fileName) as file:
+      for line in file:
+        key, _, value = line.partition(':')
+        fields[key] = value.split()
+  except OSError:
+    pass
+  return fields
+
+def measureResources(start=None, concurrent=False):
+  """measure the resources used by the current process.
+
+  Called without parameter before the step, returns a snapshot of the resources used so far. Called with this snapshot after the step, returns the resources used in between as a dict with an entry for each metric of :data:`explanes.util.resourceMetrics`:
+
+  - wallTime: elapsed wall clock time in seconds,
+  - cpuTime: processor time in seconds of the process, including its threads,
+  - peakMemory: peak resident memory of the process in bytes. On Linux, the peak is reset when the snapshot is taken, unless concurrent is True, otherwise it is the peak since the start of the process,
+  - readBytes, writtenBytes: bytes read and written by the process, as reported by /proc/self/io on Linux, nan otherwise.
+
+  As the measures are done for the whole process, they also account for the steps run concurrently by the other threads or coroutines of the process, as with the sharedmem backend or a coroutine function with nbJobs > 1. In this case, concurrent should be True, so that the peak is not reset while the other steps are running, which would spoil their measures: peakMemory is then the peak of the process since its start, or since the last reset.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> start = el.util.measureResources()
+  >>> array = bytearray(10**8)
+  >>> resources = el.util.measureResources(start)
+  >>> sorted(resources)
+  ['cpuTime', 'peakMemory', 'readBytes', 'wallTime', 'writtenBytes']
+  >>> resources['peakMemory'] > 10**8
+  True
+  """
+  if start is None and not concurrent:
+    try:
+      # resets the peak resident memory reported by /proc/self/status
+      with open('/proc/self/clear_refs', 'w') as file:
+        file.write('5')
+    except OSError:
+      pass
+  io = _readProc('io')
+  snapshot = {
+    'wallTime': time.time(),
+    'cpuTime': time.process_time(),
+    'readBytes': float(io['rchar'][0]) if 'rchar' in io else np.nan,
+    'writtenBytes': float(io['wchar'][0]) if 'wchar' in io else np.nan
+    }
+  if start is None:
+    return snapshot
+  resources = {metric: snapshot[metric]-start[metric] for metric in snapshot}
+  status = _readProc('status')
+  if 'VmHWM' in status:
+    resources['peakMemory'] = float(status['VmHWM'][0])*1024
+  else:
+    try:
+      import resource
+      # in kilobytes on Linux, in bytes on macOS
+      resources['peakMemory'] = float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)*(1 if sys.platform == 'darwin' else 1024)
+    except ImportError:
+      resources['peakMemory'] = np.nan
+  return resources
+
+def storeResources(path, id, resources):
+  """store the resources used by a setting in a data sink.
+
+  Each resource is stored as a metric of the setting, in the file <id_of_setting>_<metricName>.npy for .npy storage, or as an array of the group of the setting for .h5 storage, so that it can be reduced and displayed like any other metric by declaring it as a member of :class:`explanes.metric.Metric`.
+
+  The .h5 file is opened for each store, and the stores of the threads of a process are serialized, but the .h5 file should not be written concurrently by several processes, as with the process backend.
+
+	Parameters
+	----------
+
+  path: str
+    path to the data sink.
+
+  id: str
+    the id of the setting.
+
+  resources: dict
+    the resources used by the setting, as returned by :meth:`explanes.util.measureResources`.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> import numpy as np
+  >>> import shutil
+  >>> import os
+
+  >>> shutil.rmtree('/tmp/testResources', ignore_errors=True)
+  >>> os.makedirs('/tmp/testResources')
+  >>> el.util.storeResources('/tmp/testResources', 'f_1', {'wallTime': 2.5})
+  >>> print(np.load('/tmp/testResources/f_1_wallTime.npy'))
+  [2.5]
+  """
+  path = os.path.expanduser(path)
+  if not path.endswith('.h5'):
+    for metric, value in resources.items():
+      np.save(os.path.join(path, id+'_'+metric+'.npy'), np.array([value]))
+    return
+  with _resourcesLock:
+    h5 = tb.open_file(path, mode='a')
+    try:
+      if not h5.__contains__('/'+id):
+        h5.create_group('/', id, id)
+      settingGroup = h5.root._f_get_child(id)
+      for metric, value in resources.items():
+        if settingGroup.__contains__(metric):
+          settingGroup._f_get_child(metric)._f_remove()
+        h5.create_array(settingGroup, metric, np.array([value]), metric)
+    finally:
+      h5.close()
+
+def readMeasures(path, metric):
+  """return the values of a metric stored in a data sink for each setting, such as the resources measured by :meth:`explanes.util.storeResources`.
+
+  Returns a dict mapping the id of each setting for which the metric is stored to the mean of its values, found by listing the directory for .npy storage, or the groups of the .h5 file.
+
+	Examples
+	--------
+  >>> import explanes as el
+  >>> import numpy as np
+  >>> import shutil
+  >>> import os
+
+  >>> shutil.rmtree('/tmp/testMeasures', ignore_errors=True)
+  >>> os.makedirs('/tmp/testMeasures')
+  >>> el.util.storeResources('/tmp/testMeasures', 'f_1', {'peakMemory': 2e9})
+  >>> el.util.storeResources('/tmp/testMeasures', 'f_2', {'peakMemory': 4e9})
+  >>> el.util.readMeasures('/tmp/testMeasures', 'peakMemory')
+  {'f_1': 2000000000.0, 'f_2': 4000000000.0}
+  """
+  path = os.path.expanduser(path)
+  measures = {}
+  if not os.path.exists(path):
+    return measures
+  if path.endswith('.h5'):
+    h5 = tb.open_file(path, mode='r')
+    try:
+      for group in h5.iter_nodes('/', classname='Group'):
+        if metric in group._v_children:
+          measures[group._v_name] = float(np.mean(group._f_get_child(metric).read()))
+    finally:
+      h5.close()
+    return measures
+  suffix = '_'+metric+'.npy'
+  for fileName in sorted(os.listdir(path)):
+    if fileName.endswith(suffix):
+      measures[fileName[:-len(suffix)]] = float(np.mean(np.load(os.path.join(path, fileName))))
+  return measures
+
+def availableMemory():
+  """return the memory available for starting new processes in bytes, as reported by /proc/meminfo on Linux, or None if not available."""
+  try:
+    with open('/proc/meminfo') as file:
+      for line in file:
+        if line.startswith('MemAvailable:'):
+          return float(line.split()[1])*1024
+  except OSError:
+    pass
+  return None
 
 def inNotebook():
   """detect if the experiment is running from Ipython notebook.